@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+from analysis import runAnalysis, RESULTS_FOLD
+from sweepDesign import oneFactorDesign
+from compareResults import getPeakError
+from utils import readResultFile, analysisDetails, parseChange, deriveVariable, DERIVED_VARIABLES
+
+
+def adaptiveSweep(modelFileName='Rajagopal2015-scaled.osim',
+                  trials=['GC5_ss1', 'GC5_ss3', 'GC5_ss8', 'GC5_ss9', 'GC5_ss11'],
+                  groupNames={'Hip': ['hip_l'],
+                              'Knee': ['walker_knee_l'],
+                              'Ankle': ['ankle_l'],
+                              'Full': ['hip_l', 'walker_knee_l', 'ankle_l']},
+                  initialChanges=[-60, -40, -20, 0, 20, 40, 60],
+                  BW=75*9.81, forces=['hip', 'knee', 'ankle'], tWindow=[40, 60],
+                  tolerance=1.0, minStep=1, budget=500, nProcesses=1):
+    '''
+    runs a strength sweep that starts from a coarse grid of changes and adds
+    changes (midpoints of neighbouring changes) only where the peak metrics
+    are not linear between the changes or where the simulations turn invalid
+
+    Parameters
+    ----------
+    modelFileName  : string
+        Original (scaled) model filename
+    trials         : list of strings
+        trial names
+    groupNames     : dict
+        keys are the name of the modified models. Values are the muscle groups
+    initialChanges : list
+        the coarse grid of percent changes (0, the nominal model, is added)
+    BW             : float
+        subject's body-weight (scaling of the jrfs)
+    forces         : list
+        jrfs whose peak percent change (see compareResults.getPeakError) is
+        refined
+    tWindow        : list
+        time window of % gait cycle of the peaks
+    tolerance      : float
+        maximum error (percent points) of the linear interpolation of the
+        peak percent changes between neighbouring changes
+    minStep        : float
+        smallest difference between two changes (the changes are multiples of
+        minStep)
+    budget         : int
+        maximum number of so->jr simulations (all trials of a change count)
+    nProcesses     : int
+        number of worker processes of runAnalysis
+
+    Return
+    ----------
+    changes        : dict
+        joint-model -> sorted list of the simulated changes
+    '''
+    changes = {modelName: sorted(set(initialChanges) | set([0])) for modelName in groupNames}
+    # peak percent changes (force -> mean across trials) and validity (list
+    # across trials) of each joint-model and change
+    peaks = {modelName: {} for modelName in groupNames}
+    valid = {modelName: {} for modelName in groupNames}
+    # jrfs of each simulation (None if invalid)
+    reactions = {}
+
+    def collect(done):
+        jrFileName = os.path.basename(done['outputs'][-1])
+        results = readResultFile(os.path.join(RESULTS_FOLD, done['trial']), jrFileName, BW)
+        jrDict = results[0] if results else None
+        if jrDict is not None:
+            # only the refined forces are derived
+            for force in forces:
+                jrDict[force] = deriveVariable(DERIVED_VARIABLES[force], jrDict.get, BW)
+        reactions[(done['trial'], jrFileName)] = jrDict
+
+    newChanges = changes
+    nSimulations = 0
+    iteration = 0
+    while newChanges:
+        iteration += 1
+        design = {'factors': dict(groupNames), 'points': []}
+        for modelName, levels in newChanges.items():
+            design['points'] += oneFactorDesign({modelName: groupNames[modelName]},
+                                                levels)['points']
+        print('------------Adaptive sweep iteration {}: {} changes------------'.format(
+            iteration, len(design['points'])))
+        runAnalysis(modelFileName, trials, nProcesses, onJobDone=collect, design=design)
+        nSimulations += len(design['points'])*len(trials)
+        updatePeaks(reactions, peaks, valid, forces, tWindow)
+        # new changes within the budget (largest errors first)
+        candidates = []
+        for modelName in groupNames:
+            candidates += [(error, modelName, change) for change, error in
+                           refineChanges(changes[modelName], peaks[modelName],
+                                         valid[modelName], tolerance, minStep)]
+        nNew = max(0, (budget - nSimulations)//len(trials))
+        newChanges = {}
+        for error, modelName, change in sorted(candidates, reverse=True)[:nNew]:
+            newChanges.setdefault(modelName, []).append(change)
+        for modelName, levels in newChanges.items():
+            changes[modelName] = sorted(changes[modelName] + levels)
+    print('------------Adaptive sweep finished: {} simulations------------'.format(nSimulations))
+    return changes
+
+
+# updates the peak percent changes (mean across the valid trials) and the
+# validity of each joint-model and change from the collected jrfs
+# (trial, jr file name -> jrfs or None if invalid)
+def updatePeaks(reactions, peaks, valid, forces, tWindow):
+    # (joint-model, change) -> trial -> jrfs
+    results = {}
+    for (trial, jrFileName), jrDict in reactions.items():
+        modelName, _, reduction = analysisDetails(jrFileName)
+        change = parseChange(reduction)
+        results.setdefault((modelName, change), {})[trial] = jrDict
+    for (modelName, change), trialResults in results.items():
+        if modelName not in peaks:
+            continue
+        nominal = results.get((modelName, 0), {})
+        peakPercent = [getPeakError(jrDict, nominal[trial], forces, tWindow)[1]
+                       for trial, jrDict in trialResults.items()
+                       if jrDict is not None and nominal.get(trial) is not None]
+        valid[modelName][change] = [trialResults[trial] is not None
+                                    for trial in sorted(trialResults)]
+        if peakPercent:
+            peaks[modelName][change] = {force: np.mean([p[force] for p in peakPercent])
+                                        for force in forces}
+
+
+def refineChanges(changes, peaks, valid, tolerance=1.0, minStep=1):
+    '''
+    finds the changes to be added between the simulated changes of a
+    joint-model
+
+    Parameters
+    ----------
+    changes   : list
+        the simulated (sorted) percent changes
+    peaks     : dict
+        change -> force -> peak percent change (mean across trials). Changes
+        without a valid simulation are missing
+    valid     : dict
+        change -> validity of the simulation of each trial
+    tolerance : float
+        maximum error of the linear interpolation of the peaks (percent points)
+    minStep   : float
+        smallest difference between two changes
+
+    Return
+    ----------
+    new       : list
+        (change, priority) of the midpoints to be simulated. The error of the
+        linear interpolation is the priority, and the intervals where the
+        validity of a trial changes have an infinite priority
+    '''
+    new = {}
+
+    def addMidpoint(low, high, priority):
+        midpoint = round((low + high)/2.0/minStep)*minStep
+        if low < midpoint < high:
+            new[midpoint] = max(new.get(midpoint, 0), priority)
+
+    # boundary of the valid simulations
+    for low, high in zip(changes[:-1], changes[1:]):
+        if valid.get(low) != valid.get(high):
+            addMidpoint(low, high, np.inf)
+    # error of the linear interpolation of a change from its neighbours
+    levels = [change for change in changes if change in peaks]
+    for c0, c1, c2 in zip(levels[:-2], levels[1:-1], levels[2:]):
+        w = (c1 - c0)/float(c2 - c0)
+        error = max(abs(peaks[c1][force] - ((1 - w)*peaks[c0][force] + w*peaks[c2][force]))
+                    for force in peaks[c1])
+        if error > tolerance:
+            addMidpoint(c0, c1, error)
+            addMidpoint(c1, c2, error)
+    return sorted(new.items())
@@ -5,158 +5,654 @@ Created on Tue Jan  19 14:30:02 2020
 @author: Metin Bicer
 """
 import os
+import json
+import hashlib
+import shutil
+import time
+import tempfile
+import multiprocessing
+import numpy as np
 import opensim as osim
+from utils import (hashFile, analysisDetails, parseChange, checkSimulation,
+                   getReservePercents, readSto, RESERVE_LIMIT)
+from instrumentation import stage, startRun
+from createModels import loadMuscleJoints, readModelName
+from sweepDesign import materializeModel
+from jobQueue import JobQueue, levelPriorities, POLL_SECONDS
+
+# xml folder
+XML_FOLD = '0_xml/'
+# data folder
+DATA_FOLD = '1_data/'
+# results folder
+RESULTS_FOLD = 'Results/'
+# model main folder
+MODEL_FOLD = '2_models/'
+# records the hash of the inputs and the outputs of each finished job
+MANIFEST_FILE = RESULTS_FOLD + 'manifest.json'
+# settings of the tools (part of the hashed inputs of each job)
+TOOL_SETTINGS = {'lowpassCutoffFrequency': 6,
+                 'outputPrecision': 15,
+                 'jrJointNames': ['all'],
+                 'jrOnBody': ['child'],
+                 'jrInFrame': ['child']}
+
 
 def runAnalysis(modelFileName='Rajagopal2015-scaled.osim',
-                trials=['GC5_ss1', 'GC5_ss3', 'GC5_ss8', 'GC5_ss9', 'GC5_ss11']):
+                trials=['GC5_ss1', 'GC5_ss3', 'GC5_ss8', 'GC5_ss9', 'GC5_ss11'],
+                nProcesses=1, incremental=True, onJobDone=None, design=None,
+                inMemory=True, queueFile=None, soChunks=1, gcWindow=None, gcMargin=5):
     '''
     runs multiple id, so and jr analyses in OpenSim 3.3
-    
+
     Parameters
     ----------
     modelFileName : string
         Original (scaled) model filename
     trials        : list of strings
         trial names
+    nProcesses    : int
+        number of worker processes. The id of each trial runs first, then the
+        so->jr jobs of every (model, trial) pair are spread among the workers.
+        1 runs everything in this process. On Windows, the calling script
+        must be guarded by if __name__ == "__main__" when nProcesses > 1
+    incremental   : bool
+        if True, a job (id of a trial or so->jr of a model) only runs when the
+        hash of its inputs (model, ik, kinetics, 0_xml files and
+        TOOL_SETTINGS) differs from the one in MANIFEST_FILE or its outputs
+        are missing
+    onJobDone     : callable
+        called (in this process) with the key, trial, input hash and output
+        files of each so->jr job as soon as it has finished or is found up to
+        date, e.g. resultsStore.ResultsCollector to collect the results while
+        the remaining jobs run
+    design        : dict
+        a sweep design (see sweepDesign.py). If given, the models of its
+        points are simulated instead of the models in MODEL_FOLD. Each model
+        is written by the worker simulating it (from modelFileName) and
+        removed after its job, so the models are not stored
+    inMemory      : bool
+        if True, the so and jr tools of each job are set up on the loaded
+        model in memory. If False (or if the setup fails with the installed
+        bindings), each tool is printed to an xml file and re-read. Only the
+        setup falls back to the xml files: a tool set up in memory that
+        fails in its run fails the job
+    queueFile     : string
+        if given, the so->jr jobs to run are added to the durable queue in
+        this sqlite file (see jobQueue.py) and the workers claim them from it:
+        the nominal and the extreme changes run first, a failed job is run
+        again (up to jobQueue.MAX_ATTEMPTS) and the jobs of an interrupted run
+        (without heartbeats) are claimed again when the run is restarted.
+        Runs started with the same queueFile share the queue, and a job is
+        run by the last run that added it (with the scratch files of that
+        run)
+    soChunks      : int
+        if > 1, so runs in this many consecutive time chunks and the reserve
+        actuators are checked against the peak id moments (as in
+        utils.checkSimulation) after each chunk. A job whose reserves exceed
+        utils.RESERVE_LIMIT is stopped: the so results until then are written
+        and its jr is not run. Each chunk is a separate so run (its
+        coordinates are filtered and its frames are solved within the chunk),
+        so the results near the chunk boundaries may differ slightly from
+        those of soChunks=1. The lines of the so result files of the chunks
+        are merged as written by OpenSim
+    gcWindow      : list
+        if given, a window of the gait cycle ([start, end] in %, e.g. [40, 60])
+        or a list of windows. so and jr only run over the frames from the
+        start of the first window to the end of the last one (widened by
+        gcMargin), mapped to the time from the first and the last time of the
+        trial. id runs over the whole cycle, and the results are normalized
+        to the gait cycle with NaN out of the analyzed part (see
+        utils.readResultFile). The reserve actuators are only checked over
+        the analyzed part
+    gcMargin      : float
+        margin (% of the gait cycle) added to both sides of gcWindow, so that
+        the filtering and the interpolation at its ends do not change the
+        results within gcWindow
+
+    The wall time, cpu time and peak memory of each stage of each job are
+    appended to instrumentation.TIMING_FILE (see instrumentation.py for the
+    summary, the slowest jobs and the progress of a running sweep)
     '''
-    # xml folder
-    xmlFold = '0_xml/'
-    # data folder
-    dataFold = '1_data/'
-    # results folder
-    resultsFold = 'Results/'
-    if not os.path.isdir(resultsFold):
-        os.mkdir(resultsFold)
-    # model main folder
-    modelFold = '2_models/'
+    if not os.path.isdir(RESULTS_FOLD):
+        os.mkdir(RESULTS_FOLD)
     # original model
-    originalModelFile = modelFold + modelFileName
-    osimModel = osim.Model(originalModelFile)
-    # modified model folders
+    originalModelFile = os.path.abspath(MODEL_FOLD + modelFileName)
+    # modified models
+    modelPaths = [] if design else findModelFiles(MODEL_FOLD)
+    # the generated setup files (external loads, id, so and jr) are written to
+    # a scratch folder of this run, so that runs can share the same checkout
+    scratchFold = tempfile.mkdtemp(prefix='runAnalysis_')
+    try:
+        # unmodified model is only needed to print the external loads
+        with stage('loadModel', model=os.path.basename(originalModelFile)):
+            osimModel = osim.Model(originalModelFile)
+        trialSetups = []
+        for trial in trials:
+            with stage('setupTrial', trial):
+                trialSetups.append(setupTrial(osimModel, originalModelFile, trial, scratchFold))
+        # an so->jr job for each modified model and trial
+        jobs = [dict(setup, modelPath=modelPath, inMemory=inMemory, soChunks=soChunks)
+                for setup in trialSetups for modelPath in modelPaths]
+        if design:
+            # the muscle->joints map is cached before the workers read it
+            loadMuscleJoints(originalModelFile)
+            # the model of a design job is written by runModelJob
+            jobs = [dict(setup, modelPath=point['name'] + '.osim', baseModelFile=originalModelFile,
+                         design=dict(point, factors=design['factors']), inMemory=inMemory,
+                         soChunks=soChunks)
+                    for setup in trialSetups for point in design['points']]
+        if gcWindow:
+            # the so->jr jobs only run over the window (the id of the whole
+            # cycle is needed for the normalization)
+            for job in jobs:
+                job['startTime'], job['endTime'] = getWindowTimes(
+                    job['startTime'], job['endTime'], gcWindow, gcMargin)
+        manifest = loadManifest()
+        # hash the inputs and keep the jobs that need to run
+        fileHashes = {}
+        idSetups = selectJobs(trialSetups, 'modelFile', manifest, fileHashes, incremental)
+        allJobs = jobs
+        jobs = selectJobs(jobs, 'modelPath', manifest, fileHashes, incremental)
+        print('{} id and {} so/jr jobs to run ({} up to date)'.format(
+            len(idSetups), len(jobs),
+            len(trialSetups) + len(allJobs) - len(idSetups) - len(jobs)))
+        startRun(len(idSetups) + len(jobs))
+        queue = None
+        if queueFile:
+            queue = JobQueue(queueFile)
+            priorities = dict(zip([job['key'] for job in allJobs],
+                                  levelPriorities([getJobChanges(job) for job in allJobs])))
+            # the selected jobs run even if the queue has finished them (e.g.
+            # their outputs are missing or incremental is False)
+            queue.add(jobs, [priorities[job['key']] for job in jobs], requeue=True,
+                      run=scratchFold)
+        # finished jobs are recorded (and passed to onJobDone)
+        def jobDone(done):
+            updateManifest(manifest, done)
+            if onJobDone is not None:
+                onJobDone(done)
+        if nProcesses > 1:
+            pool = multiprocessing.Pool(nProcesses)
+            try:
+                # id of each trial before its jobs
+                for done in pool.imap_unordered(runInverseDynamics, idSetups):
+                    updateManifest(manifest, done)
+                if queue is None:
+                    # jobs run while the up to date ones are handled
+                    results = pool.imap_unordered(runModelJob, jobs)
+                    reportUpToDate(allJobs, jobs, manifest, onJobDone)
+                    for done in results:
+                        jobDone(done)
+                else:
+                    reportUpToDate(allJobs, jobs, manifest, onJobDone)
+                    runQueue(queue, scratchFold, pool.imap_unordered, jobDone)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for setup in idSetups:
+                updateManifest(manifest, runInverseDynamics(setup))
+            reportUpToDate(allJobs, jobs, manifest, onJobDone)
+            if queue is None:
+                for job in jobs:
+                    jobDone(runModelJob(job))
+            else:
+                runQueue(queue, scratchFold, map, jobDone)
+        if queue is not None:
+            print('queue: ' + ', '.join('{} {}'.format(n, state)
+                                        for state, n in sorted(queue.counts().items())))
+            queue.close()
+    finally:
+        # remove unnecessary files
+        shutil.rmtree(scratchFold, ignore_errors=True)
+
+
+# lists the modified models saved in the subfolders of modelFold
+def findModelFiles(modelFold=MODEL_FOLD):
     modelsubFolds = [x[0] for x in os.walk(modelFold)]
-    modelFileNames = []
     modelPaths = []
     for fold in modelsubFolds[1:]:
         for model in os.listdir(fold):
-            modelFileNames.append(model)
-            modelPaths.append(os.path.join(fold, model))
-
-    # appended forceset
-    forcesetFile = xmlFold + '/Forceset.xml'
-
-    for trial in trials:
-        ikFile = dataFold + trial + '.mot'
-        grfFile = dataFold + trial + '_kinetics.mot'
-        # read ik and grf
-        ik = osim.Storage(ikFile)
-        grf = osim.Storage(grfFile)
-        trialFold = resultsFold + trial
-        if not os.path.isdir(trialFold):
-            os.mkdir(trialFold)
-        # get the ExternalLoads object to write the exact path of the grfFile
-        extLoads = osim.ExternalLoads(osimModel, xmlFold + 'ExternalLoads.xml')
-        extLoads.setDataFileName(grfFile)
-        extLoads.setExternalLoadsModelKinematicsFileName(ikFile)
-        extLoads.setLowpassCutoffFrequencyForLoadKinematics(6)
-        externalLoadsFile = 'ExternalLoads.xml'
-        # print the external loads under trialFold
-        extLoads.printToXML(externalLoadsFile)
-
-        # run ID
-        idTool = osim.InverseDynamicsTool(xmlFold+'InverseDynamics.xml')
-        idTool.setModelFileName(originalModelFile)
-        idTool.setStartTime(grf.getFirstTime())
-        idTool.setEndTime(grf.getLastTime())
-        idTool.setResultsDir(trialFold)
-        idTool.setCoordinatesFileName(ikFile)
-        idTool.printToXML('id.xml')
-        idTool_run = osim.InverseDynamicsTool('id.xml')
-        idTool_run.run()
-
-        # get the SO analysis
-        soAnalysis = osim.StaticOptimization()
-        soAnalysis.setStartTime(grf.getFirstTime())
-        soAnalysis.setEndTime(grf.getLastTime())
-
-        # folders
-        soResultFolder = trialFold + '/SOResults'
-        jrResultFolder = trialFold + '/JRResults'
-        # create results folders
-        if not os.path.isdir(soResultFolder):
-            os.mkdir(soResultFolder)
-        if not os.path.isdir(jrResultFolder):
-            os.mkdir(jrResultFolder)
-
-        # create a soTool (this will be updated for each analysis)
-        soTool = osim.AnalyzeTool()
-        soTool.getAnalysisSet().adoptAndAppend(soAnalysis)
-        soTool.setInitialTime(grf.getFirstTime())
-        soTool.setFinalTime(grf.getLastTime())
-        forcesetFileStr = osim.ArrayStr()
-        forcesetFileStr.append(forcesetFile)
-        soTool.setForceSetFiles(forcesetFileStr)
-        soTool.setExternalLoadsFileName(externalLoadsFile)
-        soTool.setCoordinatesFileName(ikFile)
-        soTool.setLowpassCutoffFrequency(6)
-        soTool.setResultsDir(soResultFolder)
-        soTool.setOutputPrecision(15)
-        # create a jr analysis (this will be updated for each analysis)
-        jrAnalysis = osim.JointReaction()
-        jrAnalysis.setName('JR')
-        jrAnalysis.setStartTime(grf.getFirstTime())
-        jrAnalysis.setEndTime(grf.getLastTime())
-        # joint reactions to be calculated for jointNames exerted on
-        # onBodies and expressed in inFrame
-        jointNames = osim.ArrayStr()
-        jointNames.append('all')
-        onBodies = osim.ArrayStr()
-        onBodies.append('child')
-        inFrame = osim.ArrayStr()
-        inFrame.append('child')
-        jrAnalysis.setOnBody(onBodies)
-        jrAnalysis.setInFrame(inFrame)
-        jrAnalysis.setJointNames(jointNames)
-        # create a jr tool (this will be updated for each analysis)
-        jrTool = osim.AnalyzeTool()
-        jrTool.setResultsDir(jrResultFolder)
-        jrTool.setInitialTime(grf.getFirstTime())
-        jrTool.setFinalTime(grf.getLastTime())
-        jrTool.setExternalLoadsFileName(externalLoadsFile)
-        jrTool.setCoordinatesFileName(ikFile)
-        jrTool.setLowpassCutoffFrequency(6)
-        # set the analysis
-        jrTool.getAnalysisSet().adoptAndAppend(jrAnalysis)
-        jrTool.setOutputPrecision(15)
-        jrTool.setForceSetFiles(forcesetFileStr)
-        for newModelFile, newModelPath in zip(modelFileNames, modelPaths):
-            osimModel = osim.Model(newModelPath)
-            toolNames = osimModel.getName() + '_' + trial
-            # set soTool attribs depending on this new model
-            soTool.setName(toolNames)
-            soTool.setModelFilename(newModelPath)
-            # print the soTool (prints to the OpenSim installation directory (C:\OpenSim 3.3)
-            soTool.printToXML('so.xml')
-            # create a new soTool from the printed xml
-            soTool_run = osim.AnalyzeTool('so.xml')
-            soTool_run.run()
-
-            # jrAnalysis
-            jrAnalysis.setForcesFileName(soResultFolder + '/' + toolNames + '_StaticOptimization_force.sto')
-            # set jrtool attribs depending on this new model
-            jrTool.setModelFilename(newModelPath)
-            jrTool.setName(toolNames)
-            # print the jrTool (prints to the OpenSim installation directory (C:\OpenSim 3.3)
-            jrTool.printToXML('jr.xml')
-            # create a new soTool from the printed xml
-            jrTool_run = osim.AnalyzeTool('jr.xml')
-            jrTool_run.run()
-
-    # remove unnecessary files
-    os.remove('id.xml')
-    os.remove('so.xml')
-    os.remove('jr.xml')
-    os.remove('ExternalLoads.xml')
+            modelPaths.append(os.path.abspath(os.path.join(fold, model)))
+    return modelPaths
+
+
+# creates the results folders of a trial and prints its external loads to
+# scratchFold. Returns a dict with everything needed to run the id and the
+# so->jr jobs of the trial (all paths are absolute, as opensim resolves
+# relative paths with respect to the folder of the setup file)
+def setupTrial(osimModel, modelFile, trial, scratchFold):
+    ikFile = os.path.abspath(DATA_FOLD + trial + '.mot')
+    grfFile = os.path.abspath(DATA_FOLD + trial + '_kinetics.mot')
+    # read grf for the time range
+    grf = osim.Storage(grfFile)
+    trialFold = os.path.abspath(RESULTS_FOLD + trial)
+    # folders
+    soResultFolder = os.path.join(trialFold, 'SOResults')
+    jrResultFolder = os.path.join(trialFold, 'JRResults')
+    # create results folders
+    for fold in [trialFold, soResultFolder, jrResultFolder]:
+        if not os.path.isdir(fold):
+            os.mkdir(fold)
+    # setup files of this trial
+    trialScratchFold = os.path.join(scratchFold, trial)
+    os.mkdir(trialScratchFold)
+    # get the ExternalLoads object to write the exact path of the grfFile
+    extLoads = osim.ExternalLoads(osimModel, XML_FOLD + 'ExternalLoads.xml')
+    extLoads.setDataFileName(grfFile)
+    extLoads.setExternalLoadsModelKinematicsFileName(ikFile)
+    extLoads.setLowpassCutoffFrequencyForLoadKinematics(6)
+    externalLoadsFile = os.path.join(trialScratchFold, 'ExternalLoads.xml')
+    extLoads.printToXML(externalLoadsFile)
+    return {'trial': trial,
+            'modelFile': modelFile,
+            'ikFile': ikFile,
+            'grfFile': grfFile,
+            'externalLoadsFile': externalLoadsFile,
+            # appended forceset
+            'forcesetFile': os.path.abspath(XML_FOLD + 'ForceSet.xml'),
+            'idSetupFile': os.path.abspath(XML_FOLD + 'InverseDynamics.xml'),
+            'trialFold': trialFold,
+            'soResultFolder': soResultFolder,
+            'jrResultFolder': jrResultFolder,
+            'startTime': grf.getFirstTime(),
+            'endTime': grf.getLastTime(),
+            'scratchFold': trialScratchFold,
+            'settings': TOOL_SETTINGS}
+
+
+# maps the gait cycle windows (a [start, end] window or a list of them, in %)
+# widened by gcMargin to the times of a trial from startTime to endTime (the
+# whole cycle). Returns the times of the start of the first and the end of the
+# last window
+def getWindowTimes(startTime, endTime, gcWindow, gcMargin=5):
+    windows = np.array(gcWindow, dtype=float, ndmin=2)
+    start = max(windows[:, 0].min() - gcMargin, 0)
+    end = min(windows[:, 1].max() + gcMargin, 100)
+    return (startTime + (endTime - startTime)*start/100.0,
+            startTime + (endTime - startTime)*end/100.0)
+
+
+# sets the key and the hash of the inputs of each job and returns the jobs
+# whose hash differs from the manifest or whose outputs are missing.
+# modelKey is the job item holding the model file (modelFile for id jobs and
+# modelPath for so->jr jobs). fileHashes caches the hash of each file
+def selectJobs(jobs, modelKey, manifest, fileHashes, incremental=True):
+    selected = []
+    for job in jobs:
+        model = os.path.basename(job[modelKey])
+        job['key'] = job['trial'] + '/' + (model if modelKey == 'modelPath' else 'id')
+        # the model of a design job is hashed as its base model and changes
+        inputFiles = [job.get('baseModelFile', job[modelKey]), job['ikFile'], job['grfFile']] + \
+                     [os.path.join(XML_FOLD, f) for f in sorted(os.listdir(XML_FOLD))]
+        inputHash = hashlib.sha1()
+        for inputFile in inputFiles:
+            if inputFile not in fileHashes:
+                fileHashes[inputFile] = hashFile(inputFile)
+            inputHash.update(fileHashes[inputFile].encode())
+        settings = {'startTime': job['startTime'], 'endTime': job['endTime'],
+                    'stage': modelKey, 'tool': job['settings']}
+        if 'design' in job:
+            settings['design'] = job['design']
+        inputHash.update(json.dumps(settings, sort_keys=True).encode())
+        job['hash'] = inputHash.hexdigest()
+        record = manifest['jobs'].get(job['key'])
+        # the jr of a stopped so (see runModelJob) is skipped
+        if incremental and record and record['hash'] == job['hash'] and \
+           all(os.path.isfile(f) and os.path.getsize(f) for f in record['outputs']
+               if f not in record.get('skipped', [])):
+            continue
+        selected.append(job)
+    return selected
+
+
+# percent change of each factor of the model of a job (e.g. {'Knee': -40})
+def getJobChanges(job):
+    if 'design' in job:
+        return job['design']['changes']
+    model = os.path.splitext(os.path.basename(job['modelPath']))[0]
+    model, _, reduction = analysisDetails(model + '_')
+    return {model: parseChange(reduction)}
+
+
+# runs the pending jobs of a run (added with its scratch folder, see
+# JobQueue.add) until none is pending or running. mapJobs runs runQueuedJob
+# as many times as the pending jobs (e.g. imap_unordered of a pool) and
+# jobDone is called with each finished job. Failed jobs are pending again
+# until their last attempt. While only the jobs of the run claimed by other
+# workers are running, the queue is checked every POLL_SECONDS (their failed
+# or reclaimed jobs are run here)
+def runQueue(queue, run, mapJobs, jobDone):
+    while True:
+        queue.reclaim()
+        counts = queue.counts(run)
+        if counts['pending']:
+            for done in mapJobs(runQueuedJob, [(queue, run)]*counts['pending']):
+                if done is not None:
+                    jobDone(done)
+        elif counts['running']:
+            time.sleep(POLL_SECONDS)
+        else:
+            break
+
+
+# claims a job of a run from the queue (queueRun is the queue and the run)
+# and runs it (in a worker process) while sending heartbeats. The job is
+# finished as done or invalid (reserve actuators, see
+# utils.checkSimulation), or failed if it raises an error. Returns the
+# finished job (see runModelJob) with its state, None if no job is pending or
+# the job failed
+def runQueuedJob(queueRun):
+    queue, run = queueRun
+    job = queue.claim(run)
+    if job is None:
+        return None
+    try:
+        with queue.heartbeats(job['key']):
+            done = runModelJob(job)
+            valid = checkSimulation(job['trialFold'], os.path.basename(done['outputs'][-1]))[0]
+    except Exception as e:
+        print('{} failed: {}'.format(job['key'], e))
+        queue.fail(job['key'], e)
+        return None
+    state = 'done' if valid else 'invalid'
+    queue.finish(job['key'], done['outputs'], state)
+    return dict(done, state=state)
+
+
+# passes the jobs that are up to date (in allJobs but not in jobs to run) to
+# onJobDone with the outputs recorded in the manifest
+def reportUpToDate(allJobs, jobs, manifest, onJobDone):
+    if onJobDone is None:
+        return
+    toRun = set(job['key'] for job in jobs)
+    for job in allJobs:
+        if job['key'] not in toRun:
+            record = manifest['jobs'][job['key']]
+            onJobDone({'key': job['key'], 'trial': job['trial'], 'hash': record['hash'],
+                       'outputs': record['outputs']})
+
+
+# loads the manifest of finished jobs (an empty one if not saved yet)
+def loadManifest(manifestFile=MANIFEST_FILE):
+    if os.path.isfile(manifestFile):
+        with open(manifestFile, 'r') as fp:
+            return json.load(fp)
+    return {'jobs': {}}
+
+
+# records a finished job (returned by runInverseDynamics or runModelJob) and
+# saves the manifest, so that an interrupted run keeps its finished jobs
+def updateManifest(manifest, done, manifestFile=MANIFEST_FILE):
+    manifest['jobs'][done['key']] = {'hash': done['hash'],
+                                     'outputs': [os.path.relpath(f) for f in done['outputs']]}
+    if done.get('skipped'):
+        manifest['jobs'][done['key']]['skipped'] = [os.path.relpath(f) for f in done['skipped']]
+    tempFile = manifestFile + '.tmp'
+    with open(tempFile, 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    # replace the previous manifest at once
+    if os.path.isfile(manifestFile):
+        os.remove(manifestFile)
+    os.rename(tempFile, manifestFile)
+
+
+# runs the id of a trial (setup is returned by setupTrial)
+# returns the key, input hash and output files of the job
+def runInverseDynamics(setup):
+    trial = setup['trial']
+    with stage('idJob', trial):
+        with stage('idSetup', trial):
+            idTool = osim.InverseDynamicsTool(setup['idSetupFile'])
+            idTool.setModelFileName(setup['modelFile'])
+            idTool.setStartTime(setup['startTime'])
+            idTool.setEndTime(setup['endTime'])
+            idTool.setResultsDir(setup['trialFold'])
+            idTool.setCoordinatesFileName(setup['ikFile'])
+            idTool.setExternalLoadsFileName(setup['externalLoadsFile'])
+            idFile = os.path.join(setup['scratchFold'], 'id.xml')
+            idTool.printToXML(idFile)
+            idTool_run = osim.InverseDynamicsTool(idFile)
+        with stage('idRun', trial):
+            idTool_run.run()
+    return {'key': setup['key'], 'hash': setup['hash'],
+            'outputs': [os.path.join(setup['trialFold'], 'id.sto')]}
+
+
+# runs so and then jr of a modified model for a trial. job is a trial setup
+# (see setupTrial) with the modelPath of the modified model. The tools are set
+# up on the loaded model in memory (job inMemory) or printed to a scratch
+# folder of the job and re-read. The model of a design job (with the
+# design point and the baseModelFile) is first written to the scratch folder
+# returns the key, input hash and output files of the job (and the skipped
+# jr output if so was stopped, see runSOChunks)
+def runModelJob(job):
+    trial = job['trial']
+    model = os.path.splitext(os.path.basename(job['modelPath']))[0]
+    jobFold = tempfile.mkdtemp(dir=job['scratchFold'])
+    try:
+        with stage('modelJob', trial, model):
+            if 'design' in job:
+                with stage('writeModel', trial, model):
+                    job = dict(job, modelPath=materializeModel(
+                        job['design'], job['design']['factors'], job['baseModelFile'],
+                        os.path.join(jobFold, job['modelPath'])))
+            toolNames = readModelName(job['modelPath']) + '_' + trial
+            forcesFile = os.path.join(job['soResultFolder'],
+                                      toolNames + '_StaticOptimization_force.sto')
+            jrFile = os.path.join(job['jrResultFolder'], toolNames + '_JR_ReactionLoads.sto')
+            if job.get('soChunks', 1) > 1:
+                valid, jrModel = runSOChunks(job, toolNames, jobFold)
+            else:
+                with stage('soSetup', trial, model):
+                    # soModel is kept until the so has run (the tool does not
+                    # own it)
+                    soTool, soModel, jrModel = setupSOTool(job, toolNames, jobFold)
+                with stage('soRun', trial, model):
+                    soTool.run()
+                valid = True
+            if not valid:
+                # the results of the so are rejected (see utils.checkSimulation)
+                return {'key': job['key'], 'trial': job['trial'], 'hash': job['hash'],
+                        'outputs': [forcesFile, forcesFile[:-len('force.sto')] + 'activation.sto',
+                                    jrFile], 'skipped': [jrFile]}
+
+            with stage('jrSetup', trial, model):
+                # the so forces are read when the jr analysis is set up
+                jrTool = createJRTool(job, forcesFile)
+                if jrModel is not None:
+                    jrTool = setupToolInMemory(jrTool, jrModel, job, toolNames,
+                                               os.path.join(jobFold, 'jr.xml'))
+                else:
+                    jrTool = setupToolFromXML(jrTool, job, toolNames,
+                                              os.path.join(jobFold, 'jr.xml'))
+            with stage('jrRun', trial, model):
+                jrTool.run()
+    finally:
+        shutil.rmtree(jobFold, ignore_errors=True)
+    soPrefix = os.path.join(job['soResultFolder'], toolNames + '_StaticOptimization_')
+    return {'key': job['key'], 'trial': job['trial'], 'hash': job['hash'],
+            'outputs': [soPrefix + 'force.sto', soPrefix + 'activation.sto',
+                        os.path.join(job['jrResultFolder'], toolNames + '_JR_ReactionLoads.sto')]}
+
+
+# sets up the soTool of a job on the loaded model (job inMemory) or from its
+# printed setup file in setupFold. Returns the tool, the loaded model of the
+# tool and a copy of it for jr (the models are None if the tools are set up
+# from xml files, the copy is None if copyModel is False). The tool does not
+# own its model: the caller keeps it until the tool has run
+def setupSOTool(job, toolNames, setupFold, copyModel=True):
+    if job.get('inMemory', True):
+        try:
+            osimModel = osim.Model(job['modelPath'])
+            # so adds its forces and analyses to its model, jr runs on a copy
+            # of the loaded model
+            jrModel = osim.Model(osimModel) if copyModel else None
+            return (setupToolInMemory(createSOTool(job), osimModel, job, toolNames,
+                                      os.path.join(setupFold, 'so.xml')), osimModel, jrModel)
+        except (AttributeError, TypeError, RuntimeError) as e:
+            print('{}: so and jr tools are set up from xml files ({})'.format(job['key'], e))
+    soTool = setupToolFromXML(createSOTool(job), job, toolNames,
+                              os.path.join(setupFold, 'so.xml'))
+    return soTool, None, None
+
+
+# runs the so of a job in job soChunks consecutive time chunks (each writes
+# its results to a subfolder of jobFold) and checks the reserve actuators of
+# each chunk against the peak id moments of the trial. The so result files of
+# the chunks are merged into the so results folder of the job (see
+# mergeChunkFiles), until the chunk whose reserves exceed RESERVE_LIMIT (the
+# so is stopped there)
+# returns the validity and the model for jr (see setupSOTool)
+def runSOChunks(job, toolNames, jobFold):
+    trial = job['trial']
+    model = os.path.splitext(os.path.basename(job['modelPath']))[0]
+    nChunks = job['soChunks']
+    times = [job['startTime'] + (job['endTime'] - job['startTime'])*i/float(nChunks)
+             for i in range(nChunks + 1)]
+    # so result files of the chunks (force and activation)
+    chunkFiles = {'force': [], 'activation': []}
+    valid = True
+    for i in range(nChunks):
+        chunkFold = os.path.join(jobFold, 'so{}'.format(i))
+        os.mkdir(chunkFold)
+        chunkJob = dict(job, startTime=times[i], endTime=times[i+1], soResultFolder=chunkFold)
+        with stage('soSetup', trial, model):
+            # the model for jr is copied once
+            soTool, soModel, chunkModel = setupSOTool(chunkJob, toolNames, chunkFold, i == 0)
+        if i == 0:
+            jrModel = chunkModel
+        with stage('soRun', trial, model):
+            soTool.run()
+        for kind in chunkFiles:
+            chunkFiles[kind].append(os.path.join(
+                chunkFold, toolNames + '_StaticOptimization_' + kind + '.sto'))
+        header, labels, data = readSto(chunkFiles['force'][-1])
+        if len(data) and (getReservePercents(job['trialFold'], labels, data)[1] >
+                          RESERVE_LIMIT).any():
+            print('{}: so is stopped at {:.3f} s, reserve actuators exceed {}% of the peak id '
+                  'moments'.format(job['key'], times[i+1], RESERVE_LIMIT))
+            valid = False
+            break
+    for kind, files in chunkFiles.items():
+        mergeChunkFiles(files, os.path.join(job['soResultFolder'],
+                                            toolNames + '_StaticOptimization_' + kind + '.sto'))
+    return valid, jrModel
+
+
+# writes the storage files of consecutive time chunks as one storage file:
+# the header of the first chunk (with the merged nRows) and the lines of the
+# chunks as written by OpenSim (not reformatted). The frame at the boundary
+# of two chunks is kept once (from the earlier chunk)
+def mergeChunkFiles(chunkFiles, stoFile):
+    headerLines, lines = [], []
+    lastTime = None
+    for chunkFile in chunkFiles:
+        with open(chunkFile, 'r') as fp:
+            chunkHeader = []
+            for line in iter(fp.readline, ''):
+                chunkHeader.append(line)
+                if line.strip().lower() == 'endheader':
+                    break
+            # column labels
+            chunkHeader.append(fp.readline())
+            if not headerLines:
+                headerLines = chunkHeader
+            chunkLast = lastTime
+            for line in iter(fp.readline, ''):
+                if not line.strip():
+                    continue
+                time = float(line.split(None, 1)[0])
+                if lastTime is None or time > lastTime:
+                    lines.append(line if line.endswith('\n') else line + '\n')
+                    chunkLast = time
+            lastTime = chunkLast
+    with open(stoFile, 'w') as fp:
+        for line in headerLines:
+            if line.strip().lower().startswith('nrows='):
+                line = 'nRows={}\n'.format(len(lines))
+            fp.write(line)
+        fp.writelines(lines)
+
+
+# sets up a tool (created by createSOTool or createJRTool) to run on the
+# loaded model without printing and re-reading its setup file. setupFile is
+# the setup file the tool would be printed to (see setupToolFromXML): the
+# relative paths of its forceset files are resolved from its folder
+def setupToolInMemory(tool, osimModel, job, toolNames, setupFile):
+    tool.setName(toolNames)
+    tool.setModelFilename(job['modelPath'])
+    # append the forceset (reserve actuators) as the setup file would
+    tool.updateModelForces(osimModel, setupFile)
+    tool.setModel(osimModel)
+    return tool
+
+
+# prints a tool (created by createSOTool or createJRTool) to setupFile and
+# returns a new tool created from the printed xml (it loads the model)
+def setupToolFromXML(tool, job, toolNames, setupFile):
+    tool.setName(toolNames)
+    tool.setModelFilename(job['modelPath'])
+    tool.printToXML(setupFile)
+    return osim.AnalyzeTool(setupFile)
+
+
+# creates a soTool for the trial of the job (model and name are set per job)
+def createSOTool(job):
+    # get the SO analysis
+    soAnalysis = osim.StaticOptimization()
+    soAnalysis.setStartTime(job['startTime'])
+    soAnalysis.setEndTime(job['endTime'])
+    soTool = osim.AnalyzeTool()
+    soTool.getAnalysisSet().adoptAndAppend(soAnalysis)
+    soTool.setInitialTime(job['startTime'])
+    soTool.setFinalTime(job['endTime'])
+    forcesetFileStr = osim.ArrayStr()
+    forcesetFileStr.append(job['forcesetFile'])
+    soTool.setForceSetFiles(forcesetFileStr)
+    soTool.setExternalLoadsFileName(job['externalLoadsFile'])
+    soTool.setCoordinatesFileName(job['ikFile'])
+    soTool.setLowpassCutoffFrequency(job['settings']['lowpassCutoffFrequency'])
+    soTool.setResultsDir(job['soResultFolder'])
+    soTool.setOutputPrecision(job['settings']['outputPrecision'])
+    return soTool
+
+
+# creates a jrTool for the trial of the job using the so forces in forcesFile
+def createJRTool(job, forcesFile):
+    # create a jr analysis
+    jrAnalysis = osim.JointReaction()
+    jrAnalysis.setName('JR')
+    jrAnalysis.setStartTime(job['startTime'])
+    jrAnalysis.setEndTime(job['endTime'])
+    jrAnalysis.setForcesFileName(forcesFile)
+    # joint reactions to be calculated for jointNames exerted on
+    # onBodies and expressed in inFrame
+    jointNames = osim.ArrayStr()
+    for name in job['settings']['jrJointNames']: jointNames.append(name)
+    onBodies = osim.ArrayStr()
+    for name in job['settings']['jrOnBody']: onBodies.append(name)
+    inFrame = osim.ArrayStr()
+    for name in job['settings']['jrInFrame']: inFrame.append(name)
+    jrAnalysis.setOnBody(onBodies)
+    jrAnalysis.setInFrame(inFrame)
+    jrAnalysis.setJointNames(jointNames)
+    jrTool = osim.AnalyzeTool()
+    jrTool.setResultsDir(job['jrResultFolder'])
+    jrTool.setInitialTime(job['startTime'])
+    jrTool.setFinalTime(job['endTime'])
+    jrTool.setExternalLoadsFileName(job['externalLoadsFile'])
+    jrTool.setCoordinatesFileName(job['ikFile'])
+    jrTool.setLowpassCutoffFrequency(job['settings']['lowpassCutoffFrequency'])
+    # set the analysis
+    jrTool.getAnalysisSet().adoptAndAppend(jrAnalysis)
+    jrTool.setOutputPrecision(job['settings']['outputPrecision'])
+    forcesetFileStr = osim.ArrayStr()
+    forcesetFileStr.append(job['forcesetFile'])
+    jrTool.setForceSetFiles(forcesetFileStr)
+    return jrTool
 
 
 if __name__ == "__main__":
-    runAnalysis()
\ No newline at end of file
+    runAnalysis()
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import numpy as np
+import matplotlib
+# figures are not shown
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from utils import (JR_LOADS, readResultFiles, deriveVariables, checkSimulation, stoToNumpy,
+                   normalizeDict2GC, writeSto, getJRFileName)
+from plot import plotTrial, MUSCLE_LABELS, JOINT_MODEL_NAMES
+from compareResults import compare
+from instrumentation import cpuTime, peakRSS
+
+# coordinates of the id moments and the so reserve actuators
+COORDINATES = ['hip_flexion_l', 'hip_adduction_l', 'hip_rotation_l',
+               'knee_angle_l', 'ankle_angle_l', 'subtalar_angle_l', 'mtp_angle_l',
+               'hip_flexion_r', 'hip_adduction_r', 'hip_rotation_r',
+               'knee_angle_r', 'ankle_angle_r', 'subtalar_angle_r', 'mtp_angle_r',
+               'lumbar_extension', 'lumbar_bending', 'lumbar_rotation']
+# pelvis residuals in so results
+RESIDUALS = ['FX_residual', 'FY_residual', 'FZ_residual',
+             'MX_residual', 'MY_residual', 'MZ_residual']
+
+
+def runBenchmark(nModels=10, nTrials=1, nFrames=130, invalidFraction=0.1,
+                 nProcesses=1, fold=None, seed=0):
+    '''
+    generates synthetic results and times each stage of the post-processing
+
+    Parameters
+    ----------
+    nModels         : int
+        number of models (joint-model and change) in each trial
+    nTrials         : int
+        number of trials
+    nFrames         : int
+        number of frames in each result file
+    invalidFraction : float
+        fraction of the simulations whose reserve actuators exceed the limit
+    nProcesses      : int
+        number of worker processes of readResultFiles
+    fold            : string
+        folder of the synthetic results (a temporary folder if None, removed
+        at the end)
+    seed            : int
+        seed of the random generator
+
+    Return
+    ----------
+    report          : dict
+        the configuration and a list with the wall time, cpu time, number of
+        processed items, throughput and peak memory of the process at the end of each stage
+    '''
+    removeFold = fold is None
+    if removeFold:
+        fold = tempfile.mkdtemp(prefix='benchmark_')
+    config = {'nModels': nModels, 'nTrials': nTrials, 'nFrames': nFrames,
+              'invalidFraction': invalidFraction, 'nProcesses': nProcesses}
+    stages = []
+    try:
+        # synthetic results
+        start = startStage()
+        trials, jointModels, changes = generateResults(fold, nModels, nTrials, nFrames,
+                                                       invalidFraction, seed)
+        stages.append(endStage('generate', start, 4*nModels*nTrials))
+        trialFolds = [os.path.join(fold, trial) for trial in trials]
+        jrFiles = [os.path.join(trialFold, 'JRResults', fileName)
+                   for trialFold in trialFolds
+                   for fileName in sorted(os.listdir(os.path.join(trialFold, 'JRResults')))]
+        nBytes = sum(os.path.getsize(f) for f in jrFiles)
+
+        # parse the jr files
+        start = startStage()
+        jrDicts = [stoToNumpy(f) for f in jrFiles]
+        stages.append(endStage('stoToNumpy', start, len(jrFiles), nBytes))
+
+        # normalize the jr files
+        start = startStage()
+        for jrDict in jrDicts:
+            normalizeDict2GC(jrDict)
+        stages.append(endStage('Normalize2GC', start, len(jrDicts)))
+        del jrDicts
+
+        # check the simulations
+        start = startStage()
+        for f in jrFiles:
+            checkSimulation(os.path.dirname(os.path.dirname(f)), os.path.basename(f))
+        stages.append(endStage('checkSimulation', start, len(jrFiles)))
+
+        # read all results
+        start = startStage()
+        JRF = {}
+        for trial, trialFold in zip(trials, trialFolds):
+            JRF[trial] = readResultFiles(trialFold, 75*9.81, nProcesses)[0]
+        stages.append(endStage('readResultFiles', start, len(jrFiles), nBytes))
+
+        # derive the total and the medial and lateral knee jrfs
+        start = startStage()
+        deriveVariables(JRF, scaling=75*9.81)
+        stages.append(endStage('deriveVariables', start, len(jrFiles)))
+
+        # compare to nominal models
+        start = startStage()
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                compare(JRF, None, trials, jointModels, changes, ['hip', 'knee', 'ankle'])
+            finally:
+                sys.stdout = stdout
+        stages.append(endStage('compare', start, len(jrFiles)))
+
+        # plot a trial
+        start = startStage()
+        plotTrial(JRF, None, trials[0], jointModels, save=False)
+        plt.close('all')
+        stages.append(endStage('plotTrial', start, len(JRF[trials[0]])))
+    finally:
+        if removeFold:
+            shutil.rmtree(fold, ignore_errors=True)
+    return {'config': config, 'stages': stages,
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+
+# writes id.sto, SOResults and JRResults of synthetic simulations to
+# fold/<trial> with the same column names as OpenSim results
+# returns the trial names, joint-model names and changes of the models
+def generateResults(fold, nModels=10, nTrials=1, nFrames=130, invalidFraction=0.1,
+                    seed=0):
+    rng = np.random.RandomState(seed)
+    trials = ['GC5_ss{}'.format(i+1) for i in range(nTrials)]
+    jointModels = JOINT_MODEL_NAMES
+    # nominal and symmetric changes so that there are nModels models
+    nChanges = int(np.ceil(nModels/float(len(jointModels))))
+    changes = sorted(range(-(nChanges//2), nChanges - nChanges//2), key=abs)[:nChanges]
+    models = [(jointModel, change) for change in sorted(changes)
+              for jointModel in jointModels][:nModels]
+    time_ = np.linspace(0, 1.1, nFrames)
+    gc = np.linspace(0, 2*np.pi, nFrames)
+    muscles = sorted(MUSCLE_LABELS)
+    jrLabels = [label for joint in sorted(JR_LOADS) for label in JR_LOADS[joint]]
+    # the other side and the remaining joints of the model
+    jrLabels += [label.replace('_l', '_r') for label in jrLabels] + \
+                ['{}_on_{}_in_{}_{}'.format(joint, body, body, c)
+                 for joint, body in [('ground_pelvis', 'pelvis'), ('back', 'torso'),
+                                     ('patellofemoral_l', 'patella_l'),
+                                     ('subtalar_l', 'calcn_l'), ('mtp_l', 'toes_l')]
+                 for c in ['fx', 'fy', 'fz', 'mx', 'my', 'mz', 'px', 'py', 'pz']]
+    reserves = [c + '_reserve' for c in COORDINATES]
+    for trial in trials:
+        trialFold = os.path.join(fold, trial)
+        for sub in ['SOResults', 'JRResults']:
+            os.makedirs(os.path.join(trialFold, sub))
+        # id moments
+        idMoments = np.column_stack([(20 + 80*rng.rand())*np.sin(gc*(1 + i % 3) + rng.rand())
+                                     for i in range(len(COORDINATES))])
+        writeSto(os.path.join(trialFold, 'id.sto'),
+                 ['time'] + [c + '_moment' for c in COORDINATES] + ['pelvis_tx_force'],
+                 np.column_stack([time_, idMoments, rng.randn(nFrames)]),
+                 'Inverse Dynamics Generalized Forces')
+        peakID = np.abs(idMoments).max(axis=0)
+        for jointModel, change in models:
+            prefix = getJRFileName(jointModel, change, trial).replace('_JR_ReactionLoads.sto', '')
+            # reserves below or above the limit (percent of the peak id moments)
+            limit = 15 if rng.rand() < invalidFraction else 5
+            reserveForces = peakID*limit/100.0*np.sin(gc[:, None] + rng.rand(len(COORDINATES)))
+            activations = np.clip(0.5 + 0.4*np.sin(gc[:, None]*(1 + rng.rand(len(muscles)))), 0.01, 1)
+            muscleForces = activations*(500 + 2000*rng.rand(len(muscles)))
+            soPrefix = os.path.join(trialFold, 'SOResults', prefix + '_StaticOptimization_')
+            writeSto(soPrefix + 'force.sto', ['time'] + muscles + reserves + RESIDUALS,
+                     np.column_stack([time_, muscleForces, reserveForces,
+                                      rng.randn(nFrames, len(RESIDUALS))]),
+                     'Static Optimization')
+            writeSto(soPrefix + 'activation.sto', ['time'] + muscles,
+                     np.column_stack([time_, activations]), 'Static Optimization')
+            loads = 1000*(1 + rng.rand(len(jrLabels)))*np.sin(gc[:, None] + rng.rand(len(jrLabels)))
+            writeSto(os.path.join(trialFold, 'JRResults', prefix + '_JR_ReactionLoads.sto'),
+                     ['time'] + jrLabels, np.column_stack([time_, loads]), 'Joint Reaction')
+    return trials, jointModels, sorted(changes)
+
+
+# wall time, cpu time at the start of a stage
+def startStage():
+    return time.time(), cpuTime()
+
+
+# record of a stage started at start, processing nItems (and nBytes)
+def endStage(stage, start, nItems, nBytes=None):
+    wall = time.time() - start[0]
+    record = {'stage': stage,
+              'wallSeconds': wall,
+              'cpuSeconds': cpuTime() - start[1],
+              'items': nItems,
+              'itemsPerSecond': nItems/wall if wall > 0 else None,
+              # peak of the process until the end of the stage
+              'processPeakRSSMB': peakRSS()}
+    if nBytes is not None:
+        record['MBPerSecond'] = nBytes/1e6/wall if wall > 0 else None
+    return record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='times the post-processing of synthetic results')
+    parser.add_argument('--models', type=int, nargs='+', default=[10, 100],
+                        help='number of models in each trial (one run per value)')
+    parser.add_argument('--trials', type=int, nargs='+', default=[1, 5],
+                        help='number of trials (one run per value)')
+    parser.add_argument('--frames', type=int, default=130, help='frames in each result file')
+    parser.add_argument('--invalid', type=float, default=0.1,
+                        help='fraction of invalid simulations')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='worker processes of readResultFiles')
+    parser.add_argument('--output', default=None, help='json file of the reports (stdout if not given)')
+    args = parser.parse_args()
+    reports = [runBenchmark(nModels, nTrials, args.frames, args.invalid, args.processes)
+               for nTrials in args.trials for nModels in args.models]
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(reports, fp, indent=1)
+    else:
+        print(json.dumps(reports, indent=1))
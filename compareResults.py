@@ -6,10 +6,15 @@ Created on Thu Feb 25 11:20:40 2021
 """
 import numpy as np
 from sklearn.metrics import r2_score
-from utils import analysisDetails
+from utils import analysisDetails, parseChange
+from resultsStore import isStore, selectStore, buildStore
 import collections
+import warnings
 
 FORCE_LABELS = ['hip', 'ankle', 'knee', 'lateral', 'medial']
+# metrics printed by compare, in the order the tables (e.g. Tables 1 and 2)
+# were printed by Python 2 (the order of the keys of its dict of metrics)
+METRIC_NAMES = ['PeakVal', 'PeakPercent', 'r2', 'rmse']
 
 
 def compare(reactions, expReactions=None, 
@@ -26,61 +31,133 @@ def compare(reactions, expReactions=None,
     Parameters
     ----------
     reactions       : forces (or activations) are stored in a dict whose keys are the trials
+                      or a store (see resultsStore.buildStore)
     expReactions    : in-vivo
     trials          : trial names 
     jointModelNames : names of the models (keys of groupNames)
     changeAmounts   : amount of percent changes to be applied on the jointModel strengths
     forces          : force names
     tWindow         : time window of % gait cycle for comparison (peak deviations)
-    '''
-    # dict contains different metrics 
-    fullMetrics = {'rmse': {},
-                   'PeakPercent': {}, # percent variation at the peak
-                   'PeakVal': {}, # value of the difference at the peak
-                   'r2': {}}
 
+    Return
+    ----------
+    fullMetrics     : dict of metric name -> joint-model -> change -> force ->
+                      list of the metric of each trial (NaN for a missing
+                      simulation). getMetricsTable computes the metrics as
+                      arrays
+    '''
+    # nominal model is needed for the comparison against nominal
+    changes = list(changeAmounts)
+    if expReactions is None and 0 not in changes:
+        changes.append(0)
+    # model results stacked as (trial, joint-model, change, force, sample)
+    if isStore(reactions):
+        store = selectStore(reactions, trials, jointModelNames, changes, forces)
+    else:
+        store = buildStore(reactions, trials, jointModelNames, changes, forces)
+    data = np.asarray(store['data'])
     # if expReactions isnt given, compare the modified models against nominal
-    # and expReactions for each trial should be None
-    if expReactions == None:
+    if expReactions is None:
         diff = 'nominal model'
-        expReactions = {trial:None for trial in trials}
+        nominal = data[:, :, [changes.index(0)]]
     else:
         diff = 'in-vivo' # string to be printed if expReactions!=None
-
-    # each model (e.g. jointModel='Hip' --> Fisos of muscles crossing the hip are changed)
-    for jointModel in jointModelNames:
-        # for this model, instantiate a dict (to store each force) for each metric
-        for metricName, met in fullMetrics.items():
-            fullMetrics[metricName][jointModel] = {r:{f:[] for f in forces} for r in changeAmounts}
-        # compute the metrics for each trial
-        for trial in trials:
-            jointModel_trial_metrics = getMetrics(reactions[trial], expReactions[trial],
-                                                  jointModel, forces, tWindow)
-            # append each metric 
-            for change, changeMetric in jointModel_trial_metrics.items():
-                for metricName, met in fullMetrics.items():
-                    for force, val in changeMetric[metricName].items():
-                        fullMetrics[metricName][jointModel][change][force].append(val)
+        nominal = np.array([[[[expReactions[trial][force] for force in forces]]]
+                            for trial in trials])
+    table = getMetricsTable(data[:, :, :len(changeAmounts)], nominal, tWindow)
     # print a table for each metric
-    for metricName, metric in fullMetrics.items():
-        text = '\t\t\t\t{} (Differences from the {} across trials)\n'.format(metricName, diff)
-        text += '\t\t{:3} (mean-std)\t'.format(forces[0])
-        if len(forces)>1:
-            for force in forces[1:]:
-                text += '{:3} (mean-std)\t'.format(force)
-        text += '\n'
-        # mean and std of each metric
-        for jointModel in jointModelNames:
-            for change in changeAmounts:
-                text += '{:3} {:3}:\t'.format(change, jointModel)
-                for force in forces:
-                    metricTrials = np.array(metric[jointModel][change][force])
-                    text += '{:.2f}\t{:.2f}\t|\t'.format(np.mean(metricTrials),
-                                                         np.std(metricTrials))
-                text += '\n'
-        print(text)
+    with warnings.catch_warnings():
+        # missing (invalid) simulations are ignored in the mean and std
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for metricName in METRIC_NAMES:
+            # mean and std across trials (joint-model, change, force)
+            metricMean = np.nanmean(table[metricName], axis=0)
+            metricStd = np.nanstd(table[metricName], axis=0)
+            text = '\t\t\t\t{} (Differences from the {} across trials)\n'.format(metricName, diff)
+            text += '\t\t{:3} (mean-std)\t'.format(forces[0])
+            if len(forces)>1:
+                for force in forces[1:]:
+                    text += '{:3} (mean-std)\t'.format(force)
+            text += '\n'
+            for m, jointModel in enumerate(jointModelNames):
+                for c, change in enumerate(changeAmounts):
+                    text += '{:3} {:3}:\t'.format(change, jointModel)
+                    for f in range(len(forces)):
+                        text += '{:.2f}\t{:.2f}\t|\t'.format(metricMean[m, c, f],
+                                                             metricStd[m, c, f])
+                    text += '\n'
+            print(text)
     # return the metrics
-    return fullMetrics
+    return {metricName: {jointModel: {change: {force: list(table[metricName][:, m, c, f])
+                                               for f, force in enumerate(forces)}
+                                      for c, change in enumerate(changeAmounts)}
+                         for m, jointModel in enumerate(jointModelNames)}
+            for metricName in METRIC_NAMES}
+
+
+def getMetricsTable(modified, nominal, tWindow=[40, 60]):
+    '''
+    computes the metrics of all results at once
+    
+    Parameters
+    ----------
+    modified        : array (trial, joint-model, change, force, sample)
+    nominal         : array broadcastable to modified (e.g. the nominal model
+                      results with a single change or the in-vivo forces with
+                      single joint-model and change)
+    tWindow         : time window of % gait cycle for comparison (peak deviations)
+    
+    Return
+    ----------
+    table           : dict of metric name -> array (trial, joint-model, change, force)
+                      rmse and r2 are computed over the samples analyzed in
+                      both curves (see analysis.runAnalysis gcWindow), NaN
+                      for the missing (invalid) simulations
+    '''
+    modified = np.asarray(modified, dtype=float)
+    nominal = np.asarray(nominal, dtype=float)
+    # the peaks of a part of the gait cycle that is not analyzed are not known
+    checkWindow(modified, tWindow)
+    checkWindow(nominal, tWindow)
+    # samples analyzed in both curves
+    analyzed = np.isfinite(modified) & np.isfinite(nominal)
+    nSamples = analyzed.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        residual = np.where(analyzed, modified - nominal, 0)
+        # rmse
+        ssRes = np.sum(residual**2, axis=-1)
+        rmse = np.sqrt(ssRes/nSamples)
+        # r2 (as sklearn.metrics.r2_score(nominal, modified))
+        nominal0 = np.where(analyzed, nominal, 0)
+        nominalMean = np.sum(nominal0, axis=-1, keepdims=True)/nSamples[..., None]
+        ssTot = np.sum(np.where(analyzed, nominal0 - nominalMean, 0)**2, axis=-1)
+        r2 = np.where(ssTot != 0, 1 - ssRes/ssTot, np.where(ssRes != 0, 0., 1.))
+        r2[nSamples == 0] = np.nan
+        # peaks in the window
+        m1 = np.max(np.abs(modified[..., tWindow[0]:tWindow[1]]), axis=-1) # modified
+        m2 = np.max(np.abs(nominal[..., tWindow[0]:tWindow[1]]), axis=-1) # nominal
+        peakVal = m1-m2 # positive if increase
+        peakPercent = 100*(m1-m2)/m2 # wrt nominal
+    return {'rmse': rmse,
+            'PeakPercent': peakPercent,
+            'PeakVal': peakVal,
+            'r2': r2}
+
+
+# raises ValueError if the time window (% gait cycle) of a curve (the last
+# axis of curves) reaches outside its analyzed samples. Curves that are not
+# analyzed at all (missing simulations, all NaN) are not checked
+def checkWindow(curves, tWindow):
+    curves = np.asarray(curves, dtype=float)
+    if tWindow[0] < 0 or tWindow[1] > curves.shape[-1]:
+        raise ValueError('time window {} is outside the {} samples'.format(
+            tWindow, curves.shape[-1]))
+    analyzed = np.isfinite(curves)
+    missing = ~analyzed.any(axis=-1)
+    if (~analyzed[..., tWindow[0]:tWindow[1]] & ~missing[..., None]).any():
+        raise ValueError('time window {} is outside the analyzed part of the gait '
+                         'cycle'.format(tWindow))
+
 
 def getMetrics(reactions, expReactions=None,
                jointModel='knee', forces=FORCE_LABELS, tWindow=[40, 60]):
@@ -111,7 +188,7 @@ def getMetrics(reactions, expReactions=None,
                 # nominal model results
                 model[0] = aResult
             else:
-                model[int(red)] = aResult
+                model[parseChange(red)] = aResult
     od = collections.OrderedDict(sorted(model.items()))
     if expReactions == None:
         # if model comparison, nominal is the nominal model results
@@ -132,21 +209,30 @@ def getMetrics(reactions, expReactions=None,
     return metrics
 
 
+# samples analyzed (not NaN) in both curves
+def analyzedSamples(modified, nominal):
+    return np.isfinite(modified) & np.isfinite(nominal)
+
 # calculate R^2 (coefficient of determination) between two dicts
-# for each force in the dicts
+# for each force in the dicts (over the analyzed samples)
 def getR2(modified, nominal, forces=FORCE_LABELS):
     R2Dict = dict()
     for force in forces:
-        R2Dict[force] = r2_score(nominal[force], modified[force])
+        analyzed = analyzedSamples(modified[force], nominal[force])
+        R2Dict[force] = r2_score(np.asarray(nominal[force])[analyzed],
+                                 np.asarray(modified[force])[analyzed])
     
     return R2Dict
 
 # calculate peak differences between two dicts
-# for each force in the dicts at the given time window
+# for each force in the dicts at the given time window (ValueError if it
+# reaches outside the analyzed samples)
 def getPeakError(modified, nominal, forces=FORCE_LABELS, tWindow=[40, 60]):
     peakVal = dict() # peak value difference
     peakPercent = dict() # percent peak difference
     for force in forces:
+        checkWindow(modified[force], tWindow)
+        checkWindow(nominal[force], tWindow)
         m1 = np.max(np.abs(modified[force][tWindow[0]:tWindow[1]])) # peak value-1 (modified)
         m2 = np.max(np.abs(nominal[force][tWindow[0]:tWindow[1]])) # peak value-2 (nominal)
         peakVal[force] = m1-m2 # positive if increase 
@@ -154,10 +240,12 @@ def getPeakError(modified, nominal, forces=FORCE_LABELS, tWindow=[40, 60]):
     return peakVal, peakPercent
 
 # calculate RMSE (root-mean square error) between two dicts
-# for each force in the dicts
+# for each force in the dicts (over the analyzed samples)
 def getRMSE(modified, nominal, forces=FORCE_LABELS):
     rmseDict = dict()
     for force in forces:
-        rmseDict[force] = np.sqrt(np.mean((modified[force]-nominal[force])**2))
+        analyzed = analyzedSamples(modified[force], nominal[force])
+        residual = np.asarray(modified[force]) - np.asarray(nominal[force])
+        rmseDict[force] = np.sqrt(np.mean(residual[analyzed]**2))
         
     return rmseDict
\ No newline at end of file
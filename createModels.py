@@ -4,13 +4,24 @@ Created on Wed Mar  03 14:30:02 2020
 
 @author: metin
 """
+import io
 import os
-import opensim as osim
-from itertools import combinations
+import re
+import json
+import xml.etree.ElementTree as ET
 import numpy as np
+from utils import hashFile
+from instrumentation import stage
 
+# value of the maximum isometric force of a muscle in an .osim file
+FISO_PATTERN = re.compile(r'<max_isometric_force>\s*([^<\s]+)\s*</max_isometric_force>')
+# name of the model in an .osim file
+MODEL_NAME_PATTERN = re.compile(r'<Model\s+name="([^"]*)"')
+# folder of the muscle->joints maps of the models (keyed by the model hash)
+CACHE_FOLD = '.cache'
 
-def createModels(modelFileName='Rajagopal2015-scaled.osim', 
+
+def createModels(modelFileName='Rajagopal2015-scaled.osim',
                  groupNames={'Hip': ['hip_l'],
                              'Knee': ['walker_knee_l'],
                              'Ankle': ['ankle_l'],
@@ -18,7 +29,11 @@ def createModels(modelFileName='Rajagopal2015-scaled.osim',
                  changeAmounts=[-40, -30, -20, -10, 0, 10, 20, 30, 40]):
     '''
     creates models with different joint strengths
-    
+
+    The unmodified model is parsed once (without OpenSim) and each model is
+    written by replacing only its name and the max_isometric_force values of
+    the changed muscles in the text of the unmodified model
+
     Parameters
     ----------
     modelFileName: string
@@ -33,102 +48,205 @@ def createModels(modelFileName='Rajagopal2015-scaled.osim',
     modelFold = os.path.join(os.getcwd(), '2_models')
     # its full path
     modelFile = os.path.join(modelFold, modelFileName)
-    # load unmodified model
-    osimModel = osim.Model(modelFile)
-    osimModel.initSystem()
-    # get the muscle names
-    muscleNames = [osimModel.getMuscles().get(i).getName() for i in range(osimModel.getMuscles().getSize())]
-    # find joints spanned by each muscle
-    muscleJoints = findJoints(osimModel, muscleNames)
+    # parse unmodified model
+    with stage('parseModel', model=modelFileName):
+        baseModel = parseModel(modelFile)
+        # find joints spanned by each muscle
+        muscleJoints = loadMuscleJoints(modelFile, baseModel)
     # % change in the reduction of the maximum isometric forces
     for change in changeAmounts:
         # for each model and its muscle groups
         for modelName, groups in groupNames.items():
             # find muscles to be changed
-            musclesChanged = []
-            for muscleName, joints in muscleJoints.items():
-                 for item in joints:
-                    if item in groups:
-                 #if any(item in groups for item in joints):
-                        musclesChanged.append(muscleName)
-            musclesChanged = list(set(musclesChanged))
+            musclesChanged = findMuscles(muscleJoints, groups)
             # folder for this model group
             modelGroupFold = os.path.join(modelFold, modelName)
             # create a folder for each model group
             if not os.path.isdir(modelGroupFold):
                 os.mkdir(modelGroupFold)
-            # load unmodified model
-            osimModel = osim.Model(modelFile)
-            osimModel.initSystem()
             # set the model name depending on the change
             if change == 0:
-                osimModel.setName(modelName)
+                newModelName = modelName
             else:
-                osimModel.setName(modelName+["", "+"][change > 0] + str(change))
-            # get forcesets to update muscle max isometric forces
-            forceset = osimModel.getForceSet()
-            rGroupNames = osim.ArrayStr()
-            forceset.getGroupNames(rGroupNames)
-            # a writable reference to the model muscles
-            updMuscles = osimModel.updMuscles()
-            for name in musclesChanged:
-                muscleAbstract = updMuscles.get(name)
-                muscle = osim.Millard2012EquilibriumMuscle().safeDownCast(muscleAbstract)
-                # unmodified muscle max isometric force
-                previousMaxIsoForce = muscle.getMaxIsometricForce()
-                # update the max isometric force
-                muscle.setMaxIsometricForce(previousMaxIsoForce*(1+change/100.0))
+                newModelName = modelName+["", "+"][change > 0] + str(change)
+            # scale of the max isometric force of the changed muscles
+            scales = {name: 1+change/100.0 for name in musclesChanged}
             # print to a new modelfile
-            newModelFile = modelGroupFold + '/' + osimModel.getName()+'.osim'
-            osimModel.printToXML(newModelFile)
+            newModelFile = modelGroupFold + '/' + newModelName + '.osim'
+            with stage('writeModel', model=newModelName):
+                writeModel(baseModel, newModelName, scales, newModelFile)
     print('------------Finished creating models------------')
 
 
-def findJoints(osimModel, muscleNames):
-    # distal body (the last item in the set)
-    pairs = findChildParentPairs(osimModel)
+# parses an .osim (OpenSim 3.x) model file
+# returns a dict containing
+#   text         : the content of the file
+#   name         : the name of the model and nameSpan its position in text
+#   fiso         : list of (start, end, muscleName, maxIsometricForce), the
+#                  position of the max isometric force of each muscle in text
+#   pairs        : joint names and their [parent body, child body]
+#   muscleBodies : muscle names and the bodies of their path points
+def parseModel(modelFile):
+    with io.open(modelFile, 'r', encoding='utf-8') as fp:
+        text = fp.read()
+    model = ET.fromstring(text.encode('utf-8')).find('Model')
+    nameMatch = MODEL_NAME_PATTERN.search(text)
+    # muscles are the forces with a max isometric force (document order)
+    muscles = [force for force in model.find('ForceSet/objects')
+               if force.find('max_isometric_force') is not None]
+    fisoMatches = list(FISO_PATTERN.finditer(text))
+    if len(fisoMatches) != len(muscles):
+        raise ValueError('{}: {} max_isometric_force values for {} muscles'.format(
+            modelFile, len(fisoMatches), len(muscles)))
+    fiso = [(match.start(1), match.end(1), muscle.get('name'), float(match.group(1)))
+            for match, muscle in zip(fisoMatches, muscles)]
+    return {'text': text,
+            'name': nameMatch.group(1),
+            'nameSpan': nameMatch.span(1),
+            'fiso': fiso,
+            'pairs': findChildParentPairs(model),
+            'muscleBodies': {muscle.get('name'): findBodyNames(muscle)
+                             for muscle in muscles}}
+
+
+# name of the model in an .osim file (only the lines up to its name are read)
+def readModelName(modelFile):
+    with io.open(modelFile, 'r', encoding='utf-8') as fp:
+        for line in iter(fp.readline, u''):
+            match = MODEL_NAME_PATTERN.search(line)
+            if match:
+                return match.group(1)
+    raise ValueError('{}: no model name'.format(modelFile))
+
+
+# writes a model parsed by parseModel with the given name, and the max
+# isometric force of each muscle in scales multiplied by its scale
+def writeModel(baseModel, modelName, scales, modelFile):
+    text = baseModel['text']
+    # (start, end, replacement) in the order of the text
+    edits = [baseModel['nameSpan'] + (modelName,)]
+    for start, end, muscleName, fiso in baseModel['fiso']:
+        if muscleName in scales:
+            # repr is the shortest string giving the same double
+            edits.append((start, end, repr(fiso*scales[muscleName])))
+    pieces = []
+    previous = 0
+    for start, end, replacement in sorted(edits):
+        pieces.append(text[previous:start])
+        pieces.append(u'' + replacement)
+        previous = end
+    pieces.append(text[previous:])
+    with io.open(modelFile, 'w', encoding='utf-8') as fp:
+        fp.write(u''.join(pieces))
+
+
+# returns the joints spanned by each muscle (dict of sorted lists) from the
+# cache file of the model. The cache is created if the model (its hash) has
+# not been seen before. baseModel (parsed by parseModel) is optional
+def loadMuscleJoints(modelFile, baseModel=None, cacheFold=CACHE_FOLD):
+    cacheFile = os.path.join(cacheFold, 'muscleJoints_' + hashFile(modelFile) + '.json')
+    if os.path.isfile(cacheFile):
+        with open(cacheFile, 'r') as fp:
+            return json.load(fp)
+    if baseModel is None:
+        baseModel = parseModel(modelFile)
+    muscleJoints = findJoints(baseModel['pairs'], baseModel['muscleBodies'])
+    if not os.path.isdir(cacheFold):
+        os.mkdir(cacheFold)
+    with open(cacheFile, 'w') as fp:
+        json.dump(muscleJoints, fp, indent=1, sort_keys=True)
+    return muscleJoints
+
+
+# muscles spanning at least one of the joints in groups
+def findMuscles(muscleJoints, groups):
+    return sorted(muscleName for muscleName, joints in muscleJoints.items()
+                  if any(joint in groups for joint in joints))
+
+
+# scale of the max isometric force of each muscle for independent changes
+# (percent) of the strength of the joint groups in factors (name -> joints).
+# The scales of a muscle spanning joints of more than one factor multiply
+def muscleScales(muscleJoints, factors, changes):
+    scales = {}
+    for factor, change in changes.items():
+        for muscleName in findMuscles(muscleJoints, factors[factor]):
+            scales[muscleName] = scales.get(muscleName, 1.0)*(1+change/100.0)
+    return scales
+
+
+# finds the joints spanned by each muscle: the joints on the paths (in the
+# body tree) between the consecutive bodies of its path points
+def findJoints(pairs, muscleBodies):
+    bodyTree = buildBodyTree(pairs)
     muscleJoints = {}
-    for muscleName in muscleNames:
-        joints = []
-        bodyNames = findBodyNames(osimModel, muscleName)
-        bodyPairs = list(combinations(bodyNames, 2))
-        for body1, body2 in bodyPairs:
-            # first and last bodies in the list
-            while body1 != body2:
-                try:
-                    try:
-                        j = pairs.keys()[pairs.values().index([body1, body2])]
-                    except:
-                        j = pairs.keys()[pairs.values().index([body2, body1])]
-                    body2 = body1
-                    joints.append(j)
-                except:
-                    for j, bodies in pairs.items():
-                        if body2 == bodies[1]:
-                            joints.append(j)
-                            body2 = bodies[0]
-                            break
-        muscleJoints[muscleName] = list(set(joints))
+    for muscleName, bodyNames in muscleBodies.items():
+        joints = set()
+        for body1, body2 in zip(bodyNames[:-1], bodyNames[1:]):
+            joints.update(findJointsBetween(bodyTree, body1, body2))
+        muscleJoints[muscleName] = sorted(joints)
     return muscleJoints
 
 
-def findChildParentPairs(osimModel):
+# body tree of the model: parent body, joint to the parent body and depth
+# (number of joints to the root, e.g. ground) of each body
+def buildBodyTree(pairs):
+    parent = {}
+    joint = {}
+    for jointName, (parentBody, childBody) in pairs.items():
+        parent[childBody] = parentBody
+        joint[childBody] = jointName
+    depth = {}
+    for body in parent:
+        # walk up to a body with known depth (or the root)
+        path = []
+        while body in parent and body not in depth:
+            path.append(body)
+            body = parent[body]
+        d = depth.get(body, 0)
+        for b in reversed(path):
+            d += 1
+            depth[b] = d
+    return {'parent': parent, 'joint': joint, 'depth': depth}
+
+
+# joints between two bodies: both bodies walk up the tree to their lowest
+# common ancestor
+def findJointsBetween(bodyTree, body1, body2):
+    parent, joint, depth = bodyTree['parent'], bodyTree['joint'], bodyTree['depth']
+    joints = []
+    while body1 != body2:
+        # move the deeper body (both at the same depth but different bodies)
+        if depth.get(body1, 0) >= depth.get(body2, 0):
+            joints.append(joint[body1])
+            body1 = parent[body1]
+        else:
+            joints.append(joint[body2])
+            body2 = parent[body2]
+    return joints
+
+
+# joints of the model element and their [parent body, child body]
+# (in OpenSim 3.x, each body holds the joint connecting it to its parent)
+def findChildParentPairs(model):
     pairs = {}
-    joints = osimModel.getJointSet()
-    for i in range(joints.getSize()):
-        thisJoint = joints.get(i)
-        pairs[thisJoint.getName()] = [thisJoint.getParentName(),  # parent body
-                                      thisJoint.getBody().getName()] # child body
+    for body in model.find('BodySet/objects'):
+        joint = body.find('Joint')
+        if joint is None:
+            continue
+        for thisJoint in joint:
+            pairs[thisJoint.get('name')] = [thisJoint.findtext('parent_body').strip(),  # parent body
+                                            body.get('name')] # child body
     return pairs
 
 
-def findBodyNames(osimModel, muscleName):
-    thisMuscle = osimModel.getMuscles().get(muscleName)
-    ppSet = thisMuscle.getGeometryPath().getPathPointSet()
-    bodyNamesSet = np.array([ppSet.get(i).getBody().getName() for i in range(ppSet.getSize())])
+# bodies of the path points of a muscle element (in the order of the path)
+def findBodyNames(muscle):
+    ppSet = muscle.find('GeometryPath/PathPointSet/objects')
+    bodyNamesSet = np.array([pp.findtext('body').strip() for pp in ppSet])
     _, idx = np.unique(bodyNamesSet, return_index=True)
     return bodyNamesSet[np.sort(idx)]
 
 
 if __name__ == "__main__":
-    createModels()
\ No newline at end of file
+    createModels()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# timing records of the stages (one json object per line). None turns the
+# recording off (see setTimingFile). Worker processes started with spawn (e.g.
+# on Windows) read it from the TIMING_FILE environment variable
+TIMING_FILE = os.environ.get('TIMING_FILE', 'Results/timing.jsonl') or None
+# stages covering a whole job of runAnalysis (counted for the progress)
+JOB_STAGES = ['idJob', 'modelJob']
+
+
+@contextlib.contextmanager
+def stage(name, trial=None, model=None, logFile=None):
+    '''
+    records the wall time and cpu time of the code run in the with block, and
+    the peak memory of the process until its end, as a line of logFile (also
+    if the block raises an error)
+
+    Parameters
+    ----------
+    name    : string
+        name of the stage (e.g. soRun)
+    trial   : string
+        trial name (None if the stage is not of a trial)
+    model   : string
+        model name (None if the stage is not of a model)
+    logFile : string
+        the json lines file. Records of all processes are appended to it
+        (None for TIMING_FILE, nothing is recorded if TIMING_FILE is None)
+
+    Example
+    ----------
+    with stage('soRun', 'GC5_ss1', 'Knee-40'):
+        soTool.run()
+    '''
+    logFile = getLogFile(logFile)
+    if logFile is None:
+        yield
+        return
+    start = time.time()
+    startCPU = cpuTime()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        writeRecord({'time': start, 'pid': os.getpid(), 'stage': name,
+                     'trial': trial, 'model': model,
+                     'wallSeconds': time.time() - start,
+                     'cpuSeconds': cpuTime() - startCPU,
+                     'processPeakRSSMB': peakRSS(), 'failed': failed}, logFile)
+
+
+# sets the file of the timing records of this process and of the worker
+# processes it starts (None turns the recording off)
+def setTimingFile(logFile=None):
+    global TIMING_FILE
+    TIMING_FILE = logFile
+    os.environ['TIMING_FILE'] = logFile or ''
+
+
+# absolute path of logFile (TIMING_FILE if None). None if the recording is off
+def getLogFile(logFile=None):
+    logFile = TIMING_FILE if logFile is None else logFile
+    # opensim tools may change the working directory
+    return os.path.abspath(logFile) if logFile else None
+
+
+# records the start of a run with nJobs jobs (see JOB_STAGES), used for the
+# progress and the eta of the run
+def startRun(nJobs, logFile=None):
+    writeRecord({'time': time.time(), 'pid': os.getpid(), 'stage': 'run',
+                 'jobs': nJobs}, logFile)
+
+
+# appends a record to logFile (see getLogFile). Each record is written at
+# once, so that the lines of the processes of a pool are not mixed
+def writeRecord(record, logFile=None):
+    logFile = getLogFile(logFile)
+    if logFile is None:
+        return
+    fold = os.path.dirname(logFile)
+    if fold and not os.path.isdir(fold):
+        os.makedirs(fold)
+    with open(logFile, 'a') as fp:
+        fp.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+# user and system cpu time of this process in seconds
+def cpuTime():
+    times = os.times()
+    return times[0] + times[1]
+
+
+# peak resident memory of this process since it started in MB (None if not
+# available). It is not the peak of a stage: the later stages of a process
+# report at least the peaks of the earlier ones
+def peakRSS():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak/1e6 if sys.platform == 'darwin' else peak/1e3
+
+
+# reads the records of logFile (an unfinished last line is skipped)
+def readRecords(logFile=None):
+    records = []
+    logFile = getLogFile(logFile)
+    if logFile is None or not os.path.isfile(logFile):
+        return records
+    with open(logFile, 'r') as fp:
+        for line in iter(fp.readline, ''):
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def summarizeTiming(logFile=None, nSlowest=10):
+    '''
+    prints the time spent in each stage, the slowest jobs and the progress of
+    the last run recorded in logFile
+
+    Parameters
+    ----------
+    logFile  : string
+        the json lines file written by stage (None for TIMING_FILE)
+    nSlowest : int
+        number of slowest jobs to print
+
+    Return
+    ----------
+    summary  : dict
+        stages (stage -> count, total and max wall seconds, total cpu
+        seconds, largest peak memory of the processes running the stage),
+        slowest (records of the slowest jobs) and
+        progress (jobs done, total, elapsed and eta seconds of the last run)
+    '''
+    records = readRecords(logFile)
+    runs = [r for r in records if r['stage'] == 'run']
+    records = [r for r in records if r['stage'] != 'run']
+    # per-stage breakdown
+    stages = {}
+    for r in records:
+        s = stages.setdefault(r['stage'], {'count': 0, 'wallSeconds': 0.0, 'maxWallSeconds': 0.0,
+                                           'cpuSeconds': 0.0, 'processPeakRSSMB': None,
+                                           'failed': 0})
+        s['count'] += 1
+        s['wallSeconds'] += r['wallSeconds']
+        s['maxWallSeconds'] = max(s['maxWallSeconds'], r['wallSeconds'])
+        s['cpuSeconds'] += r['cpuSeconds']
+        # records written before processPeakRSSMB have peakRSSMB
+        peak = r.get('processPeakRSSMB', r.get('peakRSSMB'))
+        if peak is not None:
+            s['processPeakRSSMB'] = max(s['processPeakRSSMB'] or 0, peak)
+        s['failed'] += r['failed']
+    # peak memory of the processes since they started (not of the stages)
+    print('{:<18}{:>7}{:>12}{:>10}{:>10}{:>12}{:>18}{:>8}'.format(
+        'stage', 'count', 'total [s]', 'mean [s]', 'max [s]', 'cpu [s]', 'process peak [MB]',
+        'failed'))
+    for name, s in sorted(stages.items(), key=lambda item: -item[1]['wallSeconds']):
+        print('{:<18}{:>7}{:>12.1f}{:>10.2f}{:>10.2f}{:>12.1f}{:>18}{:>8}'.format(
+            name, s['count'], s['wallSeconds'], s['wallSeconds']/s['count'],
+            s['maxWallSeconds'], s['cpuSeconds'],
+            '-' if s['processPeakRSSMB'] is None else '{:.0f}'.format(s['processPeakRSSMB']),
+            s['failed']))
+    # slowest jobs
+    jobs = sorted([r for r in records if r['stage'] in JOB_STAGES],
+                  key=lambda r: -r['wallSeconds'])[:nSlowest]
+    if jobs:
+        print('\nslowest jobs')
+        for r in jobs:
+            print('{:<12}{:<14}{:<10}{:>10.1f} s{}'.format(
+                r['trial'], r['model'] or '', r['stage'], r['wallSeconds'],
+                ' (failed)' if r['failed'] else ''))
+    # progress of the last run
+    progress = None
+    if runs:
+        run = runs[-1]
+        done = len([r for r in records
+                    if r['stage'] in JOB_STAGES and r['time'] >= run['time']])
+        elapsed = time.time() - run['time']
+        eta = elapsed/done*(run['jobs'] - done) if done else None
+        progress = {'done': done, 'jobs': run['jobs'], 'elapsedSeconds': elapsed,
+                    'etaSeconds': eta}
+        print('\nlast run: {} of {} jobs done in {:.0f} s, eta {}'.format(
+            done, run['jobs'], elapsed, '-' if eta is None else '{:.0f} s'.format(eta)))
+    return {'stages': stages, 'slowest': jobs, 'progress': progress}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='summarizes the timing records of the stages')
+    parser.add_argument('--log', default=TIMING_FILE, help='the json lines file of the records')
+    parser.add_argument('--slowest', type=int, default=10, help='number of slowest jobs to print')
+    parser.add_argument('--watch', type=float, default=0,
+                        help='reprints the summary every given seconds (e.g. of a running sweep)')
+    args = parser.parse_args()
+    while True:
+        summarizeTiming(args.log, args.slowest)
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+        print('')
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import errno
+import time
+import socket
+import sqlite3
+import argparse
+import platform
+import threading
+
+# queue of the so->jr jobs of runAnalysis (see analysis.runAnalysis)
+QUEUE_FILE = 'Results/queue.sqlite'
+# states of a job
+#   pending : waiting to be claimed
+#   running : claimed by a worker (which sends heartbeats)
+#   done    : finished with a valid simulation
+#   invalid : finished, but the simulation is not valid (reserve actuators)
+#   failed  : failed maxAttempts times
+STATES = ['pending', 'running', 'done', 'invalid', 'failed']
+# seconds between the heartbeats of a running job
+HEARTBEAT_SECONDS = 30
+# a running job without a heartbeat for this many seconds is claimed again
+# (longer than the longest so or jr run, which may block the heartbeats)
+STALE_SECONDS = 3600
+# a job is failed after this many attempts
+MAX_ATTEMPTS = 3
+# seconds between the checks of a worker waiting for the running jobs of the
+# other workers (which may fail and be pending again)
+POLL_SECONDS = 10
+
+
+class JobQueue(object):
+    '''
+    durable queue of jobs in an sqlite file shared by the local workers. A
+    worker claims the pending job with the highest priority atomically, sends
+    heartbeats while it runs and finishes it (done or invalid) or fails it
+    (pending again until maxAttempts). Running jobs of an exited worker
+    process of this host, and running jobs without a recent heartbeat (e.g.
+    of a crashed worker of another host), are reclaimed, so an interrupted
+    sweep continues from its unfinished jobs. A job belongs to the run that
+    added it last (its job items, e.g. the scratch files, are of that run),
+    and a run only claims its own jobs
+
+    Parameters
+    ----------
+    queueFile    : string
+        the sqlite file (created if not found)
+    staleSeconds : float
+        a running job without a heartbeat for this many seconds is pending
+        again
+    maxAttempts  : int
+        a job is failed after this many attempts
+
+    Example
+    ----------
+    queue = JobQueue()
+    queue.add(jobs, priorities, run=scratchFold)
+    job = queue.claim(scratchFold)
+    with queue.heartbeats(job['key']):
+        done = runModelJob(job)
+    queue.finish(job['key'], done['outputs'])
+    '''
+    def __init__(self, queueFile=QUEUE_FILE, staleSeconds=STALE_SECONDS,
+                 maxAttempts=MAX_ATTEMPTS):
+        fold = os.path.dirname(queueFile)
+        if fold and not os.path.isdir(fold):
+            os.makedirs(fold)
+        # opensim tools may change the working directory
+        self.queueFile = os.path.abspath(queueFile)
+        self.staleSeconds = staleSeconds
+        self.maxAttempts = maxAttempts
+        self.worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+        # transactions are started explicitly (see transaction)
+        self.connection = sqlite3.connect(self.queueFile, timeout=60, isolation_level=None)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, hash TEXT, job TEXT, '
+            'priority REAL, state TEXT, attempts INTEGER, worker TEXT, heartbeat REAL, '
+            'outputs TEXT, error TEXT, updated REAL, run TEXT)')
+        # queues created before the runs of the jobs were saved
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(jobs)')]
+        if 'run' not in columns:
+            self.connection.execute('ALTER TABLE jobs ADD COLUMN run TEXT')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS pendingJobs ON jobs (state, priority)')
+        # jobs left running by a crashed run of this host
+        self.reclaim()
+
+    # only the settings are pickled (the file is connected again, e.g. by the
+    # worker processes of runAnalysis)
+    def __getstate__(self):
+        return {'queueFile': self.queueFile, 'staleSeconds': self.staleSeconds,
+                'maxAttempts': self.maxAttempts}
+
+    def __setstate__(self, state):
+        self.__init__(state['queueFile'], state['staleSeconds'], state['maxAttempts'])
+
+    # runs the statements of a with block as one transaction that locks the
+    # queue for writing when it starts (so a job is claimed by one worker)
+    def transaction(self):
+        return Transaction(self.connection)
+
+    def add(self, jobs, priorities=None, requeue=False, run=None):
+        '''
+        adds jobs (dicts with a key and an input hash) to the queue. A job
+        already in the queue keeps its state if its hash is the same, and is
+        pending again (with no attempts) if its hash has changed. The job
+        items (e.g. the scratch files of this run) of the jobs not running
+        are updated
+
+        Parameters
+        ----------
+        jobs       : list
+            job dicts (json serializable)
+        priorities : list
+            priority of each job (higher ones are claimed first), 0 if None
+        requeue    : bool
+            if True, the finished (done, invalid or failed) jobs with the same
+            hash are pending again with no attempts too (e.g. the jobs whose
+            outputs are missing)
+        run        : string
+            the run adding the jobs (e.g. its scratch folder). The jobs not
+            running belong to this run (see claim)
+
+        Return
+        ----------
+        nPending   : int
+            number of the added jobs that are pending
+        '''
+        if priorities is None:
+            priorities = [0]*len(jobs)
+        now = time.time()
+        nPending = 0
+        with self.transaction() as cursor:
+            for job, priority in zip(jobs, priorities):
+                row = cursor.execute('SELECT hash, state FROM jobs WHERE key = ?',
+                                     (job['key'],)).fetchone()
+                if row is None:
+                    cursor.execute('INSERT INTO jobs (key, hash, job, priority, state, attempts, '
+                                   'updated, run) VALUES (?, ?, ?, ?, ?, 0, ?, ?)',
+                                   (job['key'], job['hash'], json.dumps(job), priority,
+                                    'pending', now, run))
+                    state = 'pending'
+                elif row[0] != job['hash']:
+                    cursor.execute('UPDATE jobs SET hash = ?, job = ?, priority = ?, state = ?, '
+                                   'attempts = 0, worker = NULL, heartbeat = NULL, '
+                                   'outputs = NULL, error = NULL, updated = ?, run = ? '
+                                   'WHERE key = ?', (job['hash'], json.dumps(job), priority,
+                                                     'pending', now, run, job['key']))
+                    state = 'pending'
+                elif requeue and row[1] != 'running':
+                    cursor.execute('UPDATE jobs SET job = ?, priority = ?, state = ?, '
+                                   'attempts = 0, worker = NULL, heartbeat = NULL, '
+                                   'outputs = NULL, error = NULL, updated = ?, run = ? '
+                                   'WHERE key = ?', (json.dumps(job), priority, 'pending',
+                                                     now, run, job['key']))
+                    state = 'pending'
+                else:
+                    state = row[1]
+                    if state != 'running':
+                        cursor.execute('UPDATE jobs SET job = ?, priority = ?, run = ? '
+                                       'WHERE key = ?', (json.dumps(job), priority, run,
+                                                         job['key']))
+                nPending += state == 'pending'
+        return nPending
+
+    # claims the pending job of a run (see add) with the highest priority
+    # (None if no job of the run is pending). The jobs of the other runs are
+    # not claimed, as their job items (e.g. scratch files) may be removed.
+    # Jobs not attempted yet are claimed before the retries of the failed
+    # ones. Stale running jobs are reclaimed first
+    def claim(self, run=None):
+        self.reclaim()
+        now = time.time()
+        with self.transaction() as cursor:
+            row = cursor.execute('SELECT key, job FROM jobs WHERE state = ? AND run IS ? '
+                                 'ORDER BY attempts, priority DESC, key LIMIT 1',
+                                 ('pending', run)).fetchone()
+            if row is None:
+                return None
+            cursor.execute('UPDATE jobs SET state = ?, attempts = attempts + 1, worker = ?, '
+                           'heartbeat = ?, updated = ? WHERE key = ?',
+                           ('running', self.worker, now, now, row[0]))
+        return json.loads(row[1])
+
+    # records that the job is still running (in this worker)
+    def heartbeat(self, key):
+        with self.transaction() as cursor:
+            cursor.execute('UPDATE jobs SET heartbeat = ? WHERE key = ? AND state = ? '
+                           'AND worker = ?', (time.time(), key, 'running', self.worker))
+
+    # sends heartbeats from a thread while the with block runs
+    def heartbeats(self, key, interval=HEARTBEAT_SECONDS):
+        return Heartbeats(self.queueFile, key, self.worker, interval)
+
+    # a finished job (state is done or invalid) and its output files
+    def finish(self, key, outputs, state='done'):
+        with self.transaction() as cursor:
+            cursor.execute('UPDATE jobs SET state = ?, outputs = ?, error = NULL, updated = ? '
+                           'WHERE key = ?', (state, json.dumps(outputs), time.time(), key))
+
+    # a job that raised error: pending again, or failed after maxAttempts
+    def fail(self, key, error):
+        with self.transaction() as cursor:
+            cursor.execute('UPDATE jobs SET state = CASE WHEN attempts < ? THEN ? ELSE ? END, '
+                           'worker = NULL, error = ?, updated = ? WHERE key = ?',
+                           (self.maxAttempts, 'pending', 'failed', str(error), time.time(), key))
+
+    # running jobs of an exited process of this host, or without a heartbeat
+    # for staleSeconds, are pending again (or failed after maxAttempts).
+    # Returns the number of reclaimed jobs
+    def reclaim(self):
+        host = self.worker.rsplit(':', 1)[0]
+        with self.transaction() as cursor:
+            rows = cursor.execute('SELECT key, worker FROM jobs WHERE state = ?',
+                                  ('running',)).fetchall()
+            exited = [key for key, worker in rows
+                      if worker and worker.rsplit(':', 1)[0] == host and
+                      not isRunning(int(worker.rsplit(':', 1)[1]))]
+            update = ('UPDATE jobs SET state = CASE WHEN attempts < ? THEN ? ELSE ? END, '
+                      'worker = NULL, error = ?, updated = ? WHERE state = ? AND ')
+            nReclaimed = 0
+            for key in exited:
+                cursor.execute(update + 'key = ?', (self.maxAttempts, 'pending', 'failed',
+                                                    'worker exited', time.time(), 'running',
+                                                    key))
+                nReclaimed += cursor.rowcount
+            cursor.execute(update + 'heartbeat < ?', (self.maxAttempts, 'pending', 'failed',
+                                                      'no heartbeat', time.time(), 'running',
+                                                      time.time() - self.staleSeconds))
+            return nReclaimed + cursor.rowcount
+
+    # jobs in the given states are pending again with no attempts (e.g. the
+    # failed jobs after fixing their inputs). Returns the number of jobs
+    def reset(self, states=['failed']):
+        with self.transaction() as cursor:
+            cursor.execute('UPDATE jobs SET state = ?, attempts = 0, worker = NULL, '
+                           'updated = ? WHERE state IN ({})'.format(', '.join('?'*len(states))),
+                           ['pending', time.time()] + list(states))
+            return cursor.rowcount
+
+    # number of jobs in each state (of a run, or all the jobs if run is None)
+    def counts(self, run=None):
+        counts = dict.fromkeys(STATES, 0)
+        if run is None:
+            rows = self.connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state')
+        else:
+            rows = self.connection.execute('SELECT state, COUNT(*) FROM jobs WHERE run = ? '
+                                           'GROUP BY state', (run,))
+        counts.update(rows.fetchall())
+        return counts
+
+    # key, state, attempts, worker and error of the jobs in the given states
+    # (all if None)
+    def jobs(self, states=None):
+        rows = self.connection.execute(
+            'SELECT key, state, attempts, worker, error FROM jobs ORDER BY key').fetchall()
+        return [dict(zip(['key', 'state', 'attempts', 'worker', 'error'], row))
+                for row in rows if states is None or row[1] in states]
+
+    def close(self):
+        self.connection.close()
+
+
+class Transaction(object):
+    '''
+    with block of a transaction (BEGIN IMMEDIATE locks the database for
+    writing until COMMIT). Rolled back if the block raises an error
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection.cursor()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.connection.execute('ROLLBACK' if excType else 'COMMIT')
+        return False
+
+
+class Heartbeats(object):
+    '''
+    with block sending the heartbeats of a running job from a thread (with its
+    own connection to the queue)
+    '''
+    def __init__(self, queueFile, key, worker, interval=HEARTBEAT_SECONDS):
+        self.queueFile = queueFile
+        self.key = key
+        self.worker = worker
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def run(self):
+        connection = sqlite3.connect(self.queueFile, timeout=60)
+        try:
+            while not self.stopped.wait(self.interval):
+                with connection:
+                    connection.execute('UPDATE jobs SET heartbeat = ? WHERE key = ? AND '
+                                       'state = ? AND worker = ?',
+                                       (time.time(), self.key, 'running', self.worker))
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+
+# True if a process of this host is running (os.kill(pid, 0) would
+# terminate the process on windows, so its exit code is checked there)
+def isRunning(pid):
+    if platform.system() == 'Windows':
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        # PROCESS_QUERY_LIMITED_INFORMATION
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            # access denied: the process exists
+            return kernel32.GetLastError() == 5
+        exitCode = ctypes.c_ulong()
+        try:
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(exitCode))
+        finally:
+            kernel32.CloseHandle(handle)
+        # STILL_ACTIVE
+        return exitCode.value == 259
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM: the process exists (of another user)
+        return e.errno == errno.EPERM
+    return True
+
+
+def levelPriorities(levels):
+    '''
+    priorities that run the nominal level and the extreme levels of a sweep
+    first (e.g. the 0 and the -40 and +40 changes), then the remaining levels
+
+    Parameters
+    ----------
+    levels     : list
+        percent changes of each job (dict of factor -> change)
+
+    Return
+    ----------
+    priorities : list
+        2 for the nominal jobs (no change), 1 for the jobs with a factor at
+        its smallest or largest change, 0 for the others
+    '''
+    extremes = {}
+    for changes in levels:
+        for factor, change in changes.items():
+            low, high = extremes.get(factor, (change, change))
+            extremes[factor] = (min(low, change), max(high, change))
+    priorities = []
+    for changes in levels:
+        if not any(changes.values()):
+            priorities.append(2)
+        elif any(change and change in extremes[factor] for factor, change in changes.items()):
+            priorities.append(1)
+        else:
+            priorities.append(0)
+    return priorities
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='prints the states of the jobs of a queue')
+    parser.add_argument('--queue', default=QUEUE_FILE, help='the sqlite file of the queue')
+    parser.add_argument('--reset', nargs='*', choices=STATES,
+                        help='sets the jobs in the given states (default failed) pending again')
+    args = parser.parse_args()
+    queue = JobQueue(args.queue)
+    if args.reset is not None:
+        print('{} jobs are pending again'.format(queue.reset(args.reset or ['failed'])))
+    print(', '.join('{} {}'.format(n, state) for state, n in
+                    sorted(queue.counts().items(), key=lambda item: STATES.index(item[0]))))
+    for job in queue.jobs(['running', 'failed']):
+        print('{:<40}{:<10}{:>3} attempts  {}'.format(job['key'], job['state'], job['attempts'],
+                                                        job['error'] or job['worker']))
+    queue.close()
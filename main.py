@@ -6,7 +6,8 @@ Created on Fri Mar  6 18:43:09 2021
 """
 from createModels import createModels
 from analysis import runAnalysis
-from utils import loadModelResults, saveModelResults, loadExpJRF
+from utils import loadExpJRF
+from resultsStore import ResultsCollector, loadResultsStore, deriveStore
 from plot import plotTrial, meanPeakDeviationPlot
 from compareResults import compare
 
@@ -31,13 +32,19 @@ trials = ['GC5_ss1', 'GC5_ss3', 'GC5_ss8', 'GC5_ss9', 'GC5_ss11']
 
 # create models
 createModels(modelFileName, groupNames, changeAmounts)
-# run all trials
-runAnalysis(modelFileName, trials)
+# save the valid model results as columnar stores (trial, joint-model, change,
+# variable, sample) while running all trials
+collector = ResultsCollector(trials, jointModelNames, changeAmounts, BW)
+try:
+    runAnalysis(modelFileName, trials, onJobDone=collector)
+finally:
+    # the collected results are saved even if a job fails
+    collector.close()
 
-# save the valid model results
-JRF, SO, ACT = saveModelResults(trials, BW)
-# read the valid model results
-JRF, SO, ACT = loadModelResults()
+# read the valid model results (memory-mapped stores)
+JRF, SO, ACT = loadResultsStore()
+# total jrfs and medial and lateral knee loads (scaled by BW) of all results
+JRF = deriveStore(JRF, ['hip', 'knee', 'ankle', 'medial', 'lateral'], BW)
 # read experimental JRFs at the knee
 expJRF = loadExpJRF(BW)
 
@@ -4,14 +4,18 @@ Created on Wed Jan 20 09:41:33 2021
 
 @author: metin
 """
-from utils import analysisDetails
+from utils import analysisDetails, parseChange, getJRFileName
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 plt.style.use('fivethirtyeight')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import copy
 import os
+import multiprocessing
 import numpy as np
 from compareResults import compare
+from resultsStore import isStore, selectStore, storeToDict, selectPeakIndex, queryPeaks
 from fractions import gcd
 
 
@@ -54,14 +58,15 @@ def meanPeakDeviationPlot(reactions,
                           changeAmounts=[-40, -30, -20, -10, 0, 10, 20, 30, 40],
                           forces=['hip', 'knee', 'ankle'], tWindow=[40, 60],
                           ylim=[-0.3,0.75], compare='ACT', yticks=None, dy_ticks=0.2,
-                          save=True, save_name=''):
+                          save=True, save_name='', peakIndex=None):
     '''
     plots a chart, showing mean and std changes from the nominal model results
 
     Parameters
     ----------
     reactions: dict
-        contains a key (trial) and corresponding model forces or acts
+        contains a key (trial) and corresponding model forces or acts, or a
+        store (see resultsStore.buildStore)
     trial: list
         trial names
     jointModelNames: list
@@ -78,10 +83,21 @@ def meanPeakDeviationPlot(reactions,
         specify the type of the variables (ACT or SO or JRF)
     save: bool
         save figure if True
+    peakIndex: dict
+        peak index of the reactions (see resultsStore.buildPeakIndex). If
+        given, the peaks are read from it instead of the curves
     Return
     ----------
     metrics:        :
     '''
+    if peakIndex is not None:
+        # peaks (trial, joint-model, change, force) in the window
+        peaks = queryPeaks(selectPeakIndex(peakIndex, trials, jointModelNames,
+                                           changeAmounts, forces), [tWindow], 'max')[0][..., 0]
+    # only the plotted part of a store
+    elif isStore(reactions):
+        reactions = storeToDict(selectStore(reactions, trials, jointModelNames,
+                                            changeAmounts, forces))
     # cols and rows
     cols = {model:i for i, model in enumerate(jointModelNames)}
     rows = forces
@@ -89,26 +105,7 @@ def meanPeakDeviationPlot(reactions,
     nrows = len(rows)
     ncols = len(jointModelNames)
     # y-labels (forces)
-    ylabels = []
-    # if joint reaction forces are plotted
-    if compare == 'JRF':
-        unit = 'JRF [BW]'
-    # if so muscle forces
-    elif compare == 'SO':
-        unit = '[BW]'
-    # if activations
-    elif compare == 'ACT':
-        unit = ''
-    # ylabel = ylabel + unit
-    for ylabel in rows:
-        if compare == 'SO' or compare == 'ACT':
-            try:
-                ylabel = MUSCLE_LABELS[ylabel]
-            except:
-                pass
-            if 'biceps' not in ylabel:
-                ylabel = ylabel.replace(' ', '\n')
-        ylabels.append(' '.join([ylabel, unit]))
+    ylabels = getYLabels(rows, compare)
     # create the figure template
     # create figure and axes with the given number of rows and cols
     fig, axs = plt.subplots(nrows, ncols, figsize=(11, 11))
@@ -143,13 +140,18 @@ def meanPeakDeviationPlot(reactions,
             for iChange, change in enumerate(changeAmounts):
                 # each trial
                 metricTrials = []
-                for trial in trials:
-                    fileName = getJRFileName(jointModel, change, trial)
-                    try:
-                        peak = max(reactions[trial][fileName][force][tWindow[0]:tWindow[1]])
-                        metricTrials.append(peak)
-                    except:
-                        pass
+                if peakIndex is not None:
+                    # missing simulations are NaN
+                    metricTrials = [peak for peak in peaks[:, axColID, iChange, axRowID]
+                                    if not np.isnan(peak)]
+                else:
+                    for trial in trials:
+                        fileName = getJRFileName(jointModel, change, trial)
+                        try:
+                            peak = max(reactions[trial][fileName][force][tWindow[0]:tWindow[1]])
+                            metricTrials.append(peak)
+                        except:
+                            pass
                 # trials
                 barValues.append(metricTrials)
                 # mean and std of the trilas
@@ -175,24 +177,13 @@ def meanPeakDeviationPlot(reactions,
                 tick.label.set_fontsize(10)
             for tick in ax.yaxis.get_major_ticks():
                 tick.label.set_fontsize(10)
-    mng = plt.get_current_fig_manager()
-    mng.window.showMaximized()
+    maximizeFigure()
     plt.tight_layout()
     if save: saveCurrrentFig(fig, figname=compare+'_Changes_'+save_name, fold='Figures', format='png')
     plt.show()
 
 
 
-def getJRFileName(model, change, trial):
-    fileName = model
-    if change > 0:
-        fileName += '+' + str(change)
-    elif change < 0:
-       fileName += str(change)
-    fileName += '_' + trial + '_JR_ReactionLoads.sto'
-    return fileName
-
-
 def plotTrial(reactions, expReactions, trial='GC5_ss1',
               jointModelNames=JOINT_MODEL_NAMES, forces=FORCES,
               ylim=[0,6], compare='JRF', save=True):
@@ -202,7 +193,8 @@ def plotTrial(reactions, expReactions, trial='GC5_ss1',
     Parameters
     ----------
     reactions: dict
-        contains a key (trial) and corresponding model JRFs
+        contains a key (trial) and corresponding model JRFs, or a store
+        (see resultsStore.buildStore)
     expReactions: dict
         contains a key (trial) and corresponding in-vivo JRFs
     trial: string
@@ -215,6 +207,10 @@ def plotTrial(reactions, expReactions, trial='GC5_ss1',
     # cols and rows
     cols = {model:i for i, model in enumerate(jointModelNames)}
     rows = forces
+    # only the plotted part of a store
+    if isStore(reactions):
+        reactions = storeToDict(selectStore(reactions, [trial], jointModelNames,
+                                            variables=forces))
     # joint reaction forces in a dict whose keys are the the trials
     trialReactions = reactions[trial]
     if expReactions is not None:
@@ -222,6 +218,162 @@ def plotTrial(reactions, expReactions, trial='GC5_ss1',
     else:
         trialExpReactions = {None:None}
     # y-labels (forces)
+    ylabels = getYLabels(rows, compare)
+    # figure saving name
+    if save:
+        saveName = compare
+    else:
+        saveName = None
+    # generate the figure
+    generateFigure(trialReactions, trialExpReactions, trial,
+                   rows, cols, ylabels, ylim, saveName)
+
+
+def renderTrials(reactions, expReactions=None,
+                 trials=['GC5_ss1', 'GC5_ss3', 'GC5_ss8', 'GC5_ss9', 'GC5_ss11'],
+                 jointModelNames=JOINT_MODEL_NAMES, forces=FORCES,
+                 ylim=[0,6], compare='JRF', fold='Figures', dpi=500, nProcesses=1):
+    '''
+    saves the figure of each trial (as plotTrial) without a display. The
+    figure is created once (per worker) on the Agg canvas and only the data
+    of its lines is updated for each trial
+
+    Parameters
+    ----------
+    reactions: dict
+        contains a key (trial) and corresponding model JRFs, or a store
+        (see resultsStore.buildStore)
+    expReactions: dict
+        contains a key (trial) and corresponding in-vivo JRFs
+    trials: list
+        trial names
+    jointModelNames: list
+        axs cols (model names)
+    forces: list
+        axs rows (force headers in reactions[trial])
+    fold: string
+        folder of the figures (saved as <trial>_<compare>.png)
+    dpi: int
+        resolution of the figures
+    nProcesses: int
+        number of worker processes (the trials are divided among them)
+    Return
+    ----------
+    figures: list
+        the saved files
+    '''
+    # only the plotted part of a store
+    if isStore(reactions):
+        reactions = storeToDict(selectStore(reactions, trials, jointModelNames,
+                                            variables=forces))
+    if not os.path.isdir(fold):
+        os.mkdir(fold)
+    # trials of each worker
+    chunks = [trials[i::nProcesses] for i in range(nProcesses) if trials[i::nProcesses]]
+    jobs = [({trial: reactions[trial] for trial in chunk},
+             {trial: expReactions[trial] for trial in chunk if trial in expReactions}
+             if expReactions is not None else {},
+             chunk, jointModelNames, forces, ylim, compare, fold, dpi) for chunk in chunks]
+    if nProcesses > 1:
+        pool = multiprocessing.Pool(nProcesses)
+        try:
+            figures = pool.map(renderTrialsJob, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        figures = [renderTrialsJob(job) for job in jobs]
+    return [figure for chunkFigures in figures for figure in chunkFigures]
+
+
+# renders the trials of a worker (job is created by renderTrials) to a
+# figure template and returns the saved files
+def renderTrialsJob(job):
+    reactions, expReactions, trials, jointModelNames, forces, ylim, compare, fold, dpi = job
+    cols = {model:i for i, model in enumerate(jointModelNames)}
+    # a line for each result file (model and change) and in-vivo force of
+    # the trials
+    reductions = set()
+    for trial in trials:
+        for file in reactions[trial]:
+            model, _, change = analysisDetails(file)
+            if model in cols:
+                reductions.add(change)
+    expForces = set(force for trialExp in expReactions.values() for force in trialExp)
+    template = createTrialTemplate(forces, cols, getYLabels(forces, compare), ylim,
+                                   sorted(reductions, key=parseChange),
+                                   [force for force in forces if force in expForces])
+    figures = []
+    for trial in trials:
+        updateTrialTemplate(template, reactions[trial], expReactions.get(trial, {}), trial)
+        figures.append(os.path.join(fold, trial + '_' + compare + '.png'))
+        template['fig'].savefig(figures[-1], dpi=dpi, facecolor=template['fig'].get_facecolor())
+    return figures
+
+
+# creates the figure of generateFigure on the Agg canvas, with a line for each
+# model (cols), change (reductions as in the result file names) and row, and
+# an in-vivo line for each of expRows. Returns the figure, the axes and the
+# lines (model, reduction) -> lines of the rows and expRow -> line
+def createTrialTemplate(rows, cols, ylabels, ylim, reductions, expRows=[]):
+    fig, axs = createFigure(len(rows), len(cols.keys()), ylabels, ylim, headless=True)
+    nan = np.full(101, np.nan)
+    lines = {}
+    for model, c in cols.items():
+        axs[0, c].set_title(model)
+        for reduction in reductions:
+            change, cmap, r, lw, ls = getPlotProps(reduction, len(reductions))
+            lines[(model, reduction)] = [
+                ax.plot(nan, label=change, c=cmap.to_rgba(r), linewidth=lw, linestyle=ls,
+                        zorder=20 if change == 'Nominal' else 0)[0]
+                for ax, row in zip(axs[:, c], rows)]
+    expLines = {}
+    for row in expRows:
+        for ax in axs[rows.index(row), :]:
+            expLines.setdefault(row, []).append(
+                ax.plot(nan, linewidth=3, linestyle='-', color='Green', label='Experimental')[0])
+    title = fig.suptitle('')
+    arrangeFigure(fig)
+    return {'fig': fig, 'axs': axs, 'rows': rows, 'lines': lines, 'expLines': expLines,
+            'title': title}
+
+
+# sets the data of the lines of a template (see createTrialTemplate) to the
+# results of a trial (lines without results are not drawn)
+def updateTrialTemplate(template, trialReactions, trialExpReactions, trial):
+    results = {}
+    for file, jrf in trialReactions.items():
+        model, _, change = analysisDetails(file)
+        results[(model, change)] = jrf
+    for key, lines in template['lines'].items():
+        jrf = results.get(key)
+        for line, row in zip(lines, template['rows']):
+            setLineData(line, jrf[row] if jrf is not None else None)
+    for row, lines in template['expLines'].items():
+        for line in lines:
+            setLineData(line, trialExpReactions.get(row))
+    template['title'].set_text(trial)
+
+
+# sets the data of a line (the gait cycle samples) or hides it if y is None
+def setLineData(line, y):
+    if y is None:
+        line.set_visible(False)
+        return
+    line.set_data(np.arange(len(y)), y)
+    line.set_visible(True)
+
+
+# maximizes the window of the current figure (if the backend has a window)
+def maximizeFigure():
+    mng = plt.get_current_fig_manager()
+    window = getattr(mng, 'window', None)
+    if hasattr(window, 'showMaximized'):
+        window.showMaximized()
+
+
+# y-labels of the rows (forces) with the unit of the compared variables
+def getYLabels(rows, compare='JRF'):
     ylabels = []
     # if joint reaction forces are plotted
     if compare == 'JRF':
@@ -242,14 +394,7 @@ def plotTrial(reactions, expReactions, trial='GC5_ss1',
             if 'biceps' not in ylabel:
                 ylabel = ylabel.replace(' ', '\n')
         ylabels.append(' '.join([ylabel, unit]))
-    # figure saving name
-    if save:
-        saveName = compare
-    else:
-        saveName = None
-    # generate the figure
-    generateFigure(trialReactions, trialExpReactions, trial,
-                   rows, cols, ylabels, ylim, saveName)
+    return ylabels
 
 
 # save the figure with given figname and format in a fold
@@ -265,10 +410,18 @@ def saveCurrrentFig(fig=None, fold='', figname='', format='png'):
 
 # creates figure and returns the handles for the figure and the axes
 # to plot the total reaction forces on the hip, knee and ankle
-def createFigure(nrows, ncols, ylabels, ylim):
+# if headless, the figure is created on the Agg canvas (not by pyplot)
+def createFigure(nrows, ncols, ylabels, ylim, headless=False):
     # create figure and axes with the given number of rows and cols
-    fig, axs = plt.subplots(nrows, ncols, sharex=False, sharey=False, figsize=(16, 9))
-    if ncols == 1 or nrows == 1:
+    if headless:
+        fig = Figure(figsize=(16, 9))
+        FigureCanvasAgg(fig)
+        axs = fig.subplots(nrows, ncols, sharex=False, sharey=False)
+    else:
+        fig, axs = plt.subplots(nrows, ncols, sharex=False, sharey=False, figsize=(16, 9))
+    if ncols == 1 and nrows == 1:
+        axs = np.array([[axs]])
+    elif ncols == 1 or nrows == 1:
         axs = axs.reshape(nrows, ncols)
     fig.patch.set_facecolor('white')
     # set some properties of the axes
@@ -294,12 +447,15 @@ def createFigure(nrows, ncols, ylabels, ylim):
 
     return fig, axs
 
-# get the current fig and ax
+# get the current fig (or the given fig) and its last ax
 # order labels depending on the max iso percent change
 # adjust the subplots
-def arrangeFigure():
+def arrangeFigure(fig=None):
     # get current fig and ax
-    fig, ax = plt.gcf(), plt.gca()
+    if fig is None:
+        fig, ax = plt.gcf(), plt.gca()
+    else:
+        ax = fig.axes[-1]
     # get the handles and labels
     handles, labels = ax.get_legend_handles_labels()
     # order the labels
@@ -362,7 +518,7 @@ def generateFigure(trialReactions, trialExpReactions, trial, rows, cols, ylabels
 
 # returns a label, color and line properties depending on the % change in the model
 def getPlotProps(change, n_lines):
-    r = int(change) if change else 0
+    r = parseChange(change)
     lw = 1
     ls = '-'
     if r == 0:
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import argparse
+import numpy as np
+import utils
+from utils import readSto, writeSto
+
+# binary archive of the results tree and its index (same name, .json)
+ARCHIVE_FILE = 'Results.bin'
+# values of the archive (little-endian float64)
+ARCHIVE_DTYPE = '<f8'
+
+# The archive is one contiguous block per storage file of the results tree
+# (id.sto, SOResults/*.sto and JRResults/*.sto of each trial). A block is
+# column-major (all rows of the first column, then the second, ...), so a
+# column is a contiguous slice of the memory-mapped archive. The index maps
+# each file (path relative to the results folder, e.g.
+# GC5_ss1/JRResults/Knee-40_GC5_ss1_JR_ReactionLoads.sto) to its trial, model
+# (e.g. Knee-40, None for id.sto), kind (id, force, activation or jr), header,
+# labels, nRows and offset (in values) of the block, and the size and mtime of
+# the packed file (a file changed after packing is not read from the archive)
+
+
+def packResults(resultsFold='Results', archiveFile=ARCHIVE_FILE, trials=None, remove=False):
+    '''
+    packs the storage files of a finished results tree into a binary archive
+    and its index
+
+    Parameters
+    ----------
+    resultsFold : string
+        folder containing the results of each trial
+    archiveFile : string
+        the binary archive (the index is written next to it as .json)
+    trials      : list
+        trials (folders of resultsFold) to pack. None packs all
+    remove      : bool
+        removes the packed storage files after the archive is written (they
+        can be written again by unpackResults)
+
+    Return
+    ----------
+    index       : dict
+        the index of the archive
+    '''
+    if trials is None:
+        trials = sorted(t for t in os.listdir(resultsFold)
+                        if os.path.isdir(os.path.join(resultsFold, t)))
+    files = {}
+    offset = 0
+    textBytes = 0
+    with open(archiveFile, 'wb') as fp:
+        for trial in trials:
+            for fileName, kind, model in listStoFiles(os.path.join(resultsFold, trial)):
+                stoFile = os.path.join(resultsFold, trial, fileName)
+                header, labels, data = readSto(stoFile)
+                fileStat = os.stat(stoFile)
+                # column-major block
+                np.ascontiguousarray(data.T, dtype=ARCHIVE_DTYPE).tofile(fp)
+                files[trial + '/' + fileName] = {'trial': trial, 'model': model, 'kind': kind,
+                                                 'header': header, 'labels': labels,
+                                                 'nRows': data.shape[0], 'offset': offset,
+                                                 'size': fileStat.st_size,
+                                                 'mtime': fileStat.st_mtime}
+                offset += data.size
+                textBytes += os.path.getsize(stoFile)
+    index = {'dtype': ARCHIVE_DTYPE, 'size': offset, 'files': files}
+    with open(getIndexFile(archiveFile), 'w') as fp:
+        json.dump(index, fp, sort_keys=True)
+    print('{} files ({:.1f} MB) packed into {} ({:.1f} MB)'.format(
+        len(files), textBytes/1e6, archiveFile, os.path.getsize(archiveFile)/1e6))
+    if remove:
+        for name in files:
+            os.remove(os.path.join(resultsFold, *name.split('/')))
+        # emptied SOResults and JRResults folders
+        for trial in trials:
+            for subFold in ['SOResults', 'JRResults']:
+                fold = os.path.join(resultsFold, trial, subFold)
+                if os.path.isdir(fold) and not os.listdir(fold):
+                    os.rmdir(fold)
+    return index
+
+
+# (file name relative to the trial folder, kind, model) of the storage files
+# of a trial folder
+def listStoFiles(trialFold):
+    stoFiles = []
+    if os.path.isfile(os.path.join(trialFold, 'id.sto')):
+        stoFiles.append(('id.sto', 'id', None))
+    for subFold in ['SOResults', 'JRResults']:
+        fold = os.path.join(trialFold, subFold)
+        if not os.path.isdir(fold):
+            continue
+        for fileName in sorted(os.listdir(fold)):
+            if not fileName.endswith('.sto'):
+                continue
+            if subFold == 'JRResults':
+                kind = 'jr'
+            else:
+                # e.g. Knee-40_GC5_ss1_StaticOptimization_force.sto
+                kind = os.path.splitext(fileName)[0].split('_')[-1]
+            stoFiles.append((subFold + '/' + fileName, kind, fileName[:fileName.find('_')]))
+    return stoFiles
+
+
+def getIndexFile(archiveFile):
+    return os.path.splitext(archiveFile)[0] + '.json'
+
+
+# writes the storage files of an archive (all, or of the given trials) back
+# to resultsFold
+def unpackResults(archiveFile=ARCHIVE_FILE, resultsFold='Results', trials=None):
+    archive = ResultsArchive(archiveFile, resultsFold)
+    for name in archive.files(trials):
+        header, labels, data = archive.readStoFile(name)
+        stoFile = os.path.join(resultsFold, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(stoFile)):
+            os.makedirs(os.path.dirname(stoFile))
+        writeSto(stoFile, labels, data, header['name'], header.get('inDegrees', False))
+
+
+class ResultsArchive(object):
+    '''
+    reader of an archive written by packResults. The archive is
+    memory-mapped, so a column is read from the disk only when its values are
+    used
+
+    Parameters
+    ----------
+    archiveFile : string
+        the binary archive (its index is the .json with the same name)
+    resultsFold : string
+        folder of the packed results tree. The files are found by their
+        paths in this folder (e.g. Results/GC5_ss1/id.sto)
+
+    Example
+    ----------
+    archive = ResultsArchive('Results.bin')
+    knee = archive.column('GC5_ss1/JRResults/Knee-40_GC5_ss1_JR_ReactionLoads.sto',
+                          'walker_knee_l_on_tibia_l_in_tibia_l_fy')
+    '''
+    def __init__(self, archiveFile=ARCHIVE_FILE, resultsFold='Results'):
+        # opensim tools may change the working directory
+        self.archiveFile = os.path.abspath(archiveFile)
+        self.resultsFold = resultsFold
+        self.root = os.path.abspath(resultsFold)
+        with open(getIndexFile(archiveFile), 'r') as fp:
+            self.index = json.load(fp)
+        if self.index['size']:
+            self.data = np.memmap(archiveFile, dtype=self.index['dtype'], mode='r',
+                                  shape=(self.index['size'],))
+        else:
+            self.data = np.zeros(0)
+
+    # only the files are pickled (the archive is mapped again, e.g. by the
+    # worker processes of utils.readResultFiles)
+    def __getstate__(self):
+        return {'archiveFile': self.archiveFile, 'resultsFold': self.resultsFold,
+                'root': self.root}
+
+    def __setstate__(self, state):
+        self.__init__(state['archiveFile'], state['resultsFold'])
+        self.root = state['root']
+
+    # names of the packed files, filtered by trials (list), kind and model
+    def files(self, trials=None, kind=None, model=None):
+        return sorted(name for name, entry in self.index['files'].items()
+                      if (trials is None or entry['trial'] in trials) and
+                      (kind is None or entry['kind'] == kind) and
+                      (model is None or entry['model'] == model))
+
+    # header, labels and data (rows x columns view of the archive) of a
+    # packed file (name in the index)
+    def readStoFile(self, name):
+        entry = self.index['files'][name]
+        nRows, labels = entry['nRows'], entry['labels']
+        block = self.data[entry['offset']:entry['offset'] + nRows*len(labels)]
+        return dict(entry['header']), list(labels), block.reshape(len(labels), nRows).T
+
+    # a column of a packed file (a view of the archive)
+    def column(self, name, label):
+        entry = self.index['files'][name]
+        start = entry['offset'] + entry['labels'].index(label)*entry['nRows']
+        return self.data[start:start + entry['nRows']]
+
+    # name in the index of a storage file of the results tree (None if the
+    # file is not in resultsFold or not packed)
+    def getName(self, stoFile):
+        try:
+            name = os.path.relpath(os.path.abspath(stoFile), self.root)
+        except ValueError:  # another drive
+            return None
+        name = name.replace(os.sep, '/')
+        return name if name in self.index['files'] else None
+
+    # same as utils.readSto for a packed file (None if not packed, or if the
+    # file is found with a size or mtime other than the packed one, e.g. of a
+    # simulation run again after packing)
+    def readSto(self, stoFile):
+        name = self.getName(stoFile)
+        if name is None or self.isChanged(name, stoFile):
+            return None
+        return self.readStoFile(name)
+
+    # True if the storage file of a packed file (name) is found and differs
+    # from the packed one (its size or mtime)
+    def isChanged(self, name, stoFile):
+        if not os.path.isfile(stoFile):
+            return False
+        entry = self.index['files'][name]
+        if 'size' not in entry:
+            # packed before the sizes were saved
+            return True
+        fileStat = os.stat(stoFile)
+        return fileStat.st_size != entry['size'] or abs(fileStat.st_mtime - entry['mtime']) > 1e-3
+
+    # sorted file names of a folder of the results tree (None if the folder
+    # has no packed files)
+    def listdir(self, fold):
+        try:
+            prefix = os.path.relpath(os.path.abspath(fold), self.root).replace(os.sep, '/') + '/'
+        except ValueError:
+            return None
+        names = [name[len(prefix):] for name in self.index['files'] if name.startswith(prefix)]
+        names = sorted(name for name in names if '/' not in name)
+        return names or None
+
+
+# reads the files of an archive (instead of the unchanged or removed storage
+# files) in every utils.readSto call. An archive of the same file used
+# before is replaced (e.g. after packing it again). Returns the opened archive
+def useArchive(archiveFile=ARCHIVE_FILE, resultsFold='Results'):
+    archive = ResultsArchive(archiveFile, resultsFold)
+    utils.ARCHIVES[:] = [a for a in utils.ARCHIVES if a.archiveFile != archive.archiveFile]
+    utils.ARCHIVES.append(archive)
+    return archive
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='packs the storage files of the results tree '
+                                                 'into a memory-mapped binary archive')
+    parser.add_argument('--results', default='Results', help='the results folder')
+    parser.add_argument('--archive', default=ARCHIVE_FILE, help='the binary archive')
+    parser.add_argument('--trials', nargs='+', help='trials to pack or unpack (default all)')
+    parser.add_argument('--remove', action='store_true',
+                        help='removes the packed storage files')
+    parser.add_argument('--unpack', action='store_true',
+                        help='writes the storage files of the archive back to the results folder')
+    args = parser.parse_args()
+    if args.unpack:
+        unpackResults(args.archive, args.results, args.trials)
+    else:
+        packResults(args.results, args.archive, args.trials, args.remove)
@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import collections
+import numpy as np
+from utils import (analysisDetails, parseChange, getJRFileName, readResultFile,
+                   writeValidityReport, deriveVariable, DERIVED_VARIABLES)
+from instrumentation import stage
+
+# folder of the stores (the name given to the results files is its prefix)
+STORE_FOLD = 'ResultsStore'
+# result kinds saved by saveModelResults
+RESULT_KINDS = ['JRF', 'SO', 'ACT']
+# axes of the data array of a store (each axis except samples has labels)
+STORE_AXES = ['trials', 'jointModels', 'changes', 'variables']
+# variables (raw or derived) of each result kind whose peak index is saved
+# with the stores
+PEAK_INDEX_VARIABLES = {'JRF': ['hip', 'knee', 'ankle', 'medial', 'lateral']}
+# tables of a peak index (values and their positions in the gait cycle)
+PEAK_TABLES = ['max', 'maxArg', 'absMax', 'absMaxArg']
+
+
+def buildStore(results, trials=None, jointModels=None, changes=None, variables=None):
+    '''
+    stacks results into a dense array with labelled axes (a store)
+
+    Parameters
+    ----------
+    results     : dict
+        trial -> result file name -> variable -> gait cycle samples
+        (JRF, SO or ACT returned by saveModelResults)
+    trials, jointModels, changes, variables : list
+        labels of each axis. If None, all the labels found in results are used
+        (sorted)
+
+    Return
+    ----------
+    store       : dict
+        data (float array with axes trial, joint-model, change, variable,
+        gait cycle sample, NaN if the simulation is missing or invalid) and a
+        list of labels for each axis in STORE_AXES
+    '''
+    # model name and change of each result file
+    entries = []
+    for trial, trialResults in results.items():
+        for fileName, fileResults in trialResults.items():
+            model, _, change = analysisDetails(fileName)
+            entries.append((trial, model, parseChange(change), fileResults))
+    if trials is None:
+        trials = sorted(set(e[0] for e in entries))
+    if jointModels is None:
+        jointModels = sorted(set(e[1] for e in entries))
+    if changes is None:
+        changes = sorted(set(e[2] for e in entries))
+    if variables is None:
+        variables = sorted(set(v for e in entries for v in e[3]))
+    nSamples = max([len(data) for e in entries for data in e[3].values()] or [0])
+    data = np.full((len(trials), len(jointModels), len(changes), len(variables), nSamples),
+                   np.nan)
+    index = [{label: i for i, label in enumerate(labels)}
+             for labels in [trials, jointModels, changes, variables]]
+    for trial, model, change, fileResults in entries:
+        try:
+            i, j, k = index[0][trial], index[1][model], index[2][change]
+        except KeyError:
+            # not selected
+            continue
+        for variable, values in fileResults.items():
+            if variable in index[3]:
+                data[i, j, k, index[3][variable]] = values
+    return {'data': data, 'trials': list(trials), 'jointModels': list(jointModels),
+            'changes': list(changes), 'variables': list(variables)}
+
+
+# returns True if results is a store (see buildStore)
+def isStore(results):
+    return isinstance(results, dict) and 'data' in results and 'variables' in results
+
+
+# returns a store with the selected labels of each axis (None selects all)
+# labels not in the store are kept and their data is NaN, so the axes of the
+# returned store are exactly the selected labels
+# the data of a memory-mapped store is only read for the selection
+def selectStore(store, trials=None, jointModels=None, changes=None, variables=None):
+    selected = dict(store)
+    # derived variables (see deriveStore) are of the data of store
+    selected.pop('derived', None)
+    data = store['data']
+    for axis, (name, labels) in enumerate(zip(STORE_AXES,
+                                              [trials, jointModels, changes, variables])):
+        if labels is None:
+            continue
+        labels = list(labels)
+        index = np.array([store[name].index(label) if label in store[name] else -1
+                          for label in labels], dtype=int)
+        if data.shape[axis]:
+            data = np.take(data, np.maximum(index, 0), axis=axis)
+        else:
+            data = np.zeros(data.shape[:axis] + (len(labels),) + data.shape[axis+1:])
+        if (index < 0).any():
+            data[(slice(None),)*axis + (index < 0,)] = np.nan
+        selected[name] = labels
+    selected['data'] = data
+    return selected
+
+
+# converts a store into dict of trial -> result file name -> variable -> samples
+# (the structure returned by saveModelResults). Arrays are views of the store
+def storeToDict(store):
+    results = {}
+    data = store['data']
+    for i, trial in enumerate(store['trials']):
+        results[trial] = {}
+        for j, model in enumerate(store['jointModels']):
+            for k, change in enumerate(store['changes']):
+                values = data[i, j, k]
+                # missing simulation
+                if np.isnan(values).all():
+                    continue
+                results[trial][getJRFileName(model, change, trial)] = \
+                    {variable: values[v] for v, variable in enumerate(store['variables'])}
+    return results
+
+
+def deriveStore(store, variables, scaling=1, definitions=DERIVED_VARIABLES):
+    '''
+    returns a store of the given variables, which can be variables of store or
+    variables derived from them (e.g. the resultant hip, knee and ankle jrfs
+    and the medial and lateral knee loads, see utils.DERIVED_VARIABLES)
+
+    A derived variable is computed for all the results at once (from the
+    stacked inputs) the first time it is requested, and kept in store (under
+    derived) for the next requests
+
+    Parameters
+    ----------
+    store       : dict
+        results with labelled axes (see buildStore), e.g. JRF
+    variables   : list
+        variables of the returned store
+    scaling     : float
+        the parameter to scale the derived variables (e.g. BW)
+    definitions : dict
+        definitions of the derived variables
+
+    Return
+    ----------
+    selected    : dict
+        store of the variables (in memory)
+    '''
+    selected = selectStore(store, variables=variables)
+    data = np.array(selected['data'])
+    cache = store.setdefault('derived', {})
+    for v, name in enumerate(variables):
+        if name in store['variables'] or name not in definitions:
+            continue
+        definition = definitions[name]
+        key = (name, scaling, json.dumps(definition, sort_keys=True))
+        if key not in cache:
+            inputs = list(definition['inputs'])
+            inputData = np.asarray(selectStore(store, variables=inputs)['data'])
+            cache[key] = deriveVariable(definition,
+                                        lambda input: inputData[..., inputs.index(input), :],
+                                        scaling)
+        data[..., v, :] = cache[key]
+    selected['data'] = data
+    return selected
+
+
+# saves a store to fold: data to kind.npy (NumPy binary format) and the labels
+# of the axes to kind.json
+def saveStore(store, kind, fold=STORE_FOLD):
+    if not os.path.isdir(fold):
+        os.makedirs(fold)
+    np.save(os.path.join(fold, kind + '.npy'), store['data'])
+    with open(os.path.join(fold, kind + '.json'), 'w') as fp:
+        json.dump({name: store[name] for name in STORE_AXES}, fp, indent=1)
+
+
+# loads a store saved by saveStore. If mmap, the data is memory-mapped and
+# only the selected labels (see selectStore) are read
+def loadStore(kind, fold=STORE_FOLD, mmap=True, **selection):
+    with open(os.path.join(fold, kind + '.json'), 'r') as fp:
+        store = json.load(fp)
+    store['data'] = np.load(os.path.join(fold, kind + '.npy'),
+                            mmap_mode='r' if mmap else None)
+    if selection:
+        store = selectStore(store, **selection)
+    return store
+
+
+# builds and saves the stores of JRF, SO and ACT (returned by saveModelResults)
+# (and the peak indices of PEAK_INDEX_VARIABLES, scaled by scaling)
+def saveResultsStore(JRF, SO, ACT, saveFile='', scaling=1):
+    for kind, results in zip(RESULT_KINDS, [JRF, SO, ACT]):
+        store = buildStore(results)
+        saveStore(store, kind, saveFile + STORE_FOLD)
+        if kind in PEAK_INDEX_VARIABLES:
+            savePeakIndex(buildPeakIndex(deriveStore(store, PEAK_INDEX_VARIABLES[kind], scaling)),
+                          kind, saveFile + STORE_FOLD)
+
+
+# loads the stores of JRF, SO and ACT (memory-mapped)
+def loadResultsStore(loadFile=''):
+    return [loadStore(kind, loadFile + STORE_FOLD) for kind in RESULT_KINDS]
+
+
+def buildPeakIndex(store, variables=None):
+    '''
+    builds sparse tables of the maximum and the absolute maximum of each curve
+    of a store, so that the peak of any gait cycle window is found by
+    comparing two entries (see queryPeaks)
+
+    Parameters
+    ----------
+    store     : dict
+        results with labelled axes (see buildStore)
+    variables : list
+        variables to index (None indexes all the variables of the store)
+
+    Return
+    ----------
+    index     : dict
+        the labels of the store and a table for each of PEAK_TABLES with axes
+        trial, joint-model, change, variable, level, sample. Level k holds the
+        peak (or its position) of the 2**k samples starting at each sample
+    '''
+    if variables is not None:
+        store = selectStore(store, variables=variables)
+    data = np.asarray(store['data'], dtype=float)
+    nSamples = data.shape[-1]
+    nLevels = max(nSamples, 1).bit_length()
+    index = {name: list(store[name]) for name in STORE_AXES}
+    for name, values in [('max', data), ('absMax', np.abs(data))]:
+        table = np.full(data.shape[:-1] + (nLevels, nSamples), np.nan)
+        positions = np.zeros(table.shape, dtype=np.int16)
+        table[..., 0, :] = values
+        positions[..., 0, :] = np.arange(nSamples)
+        for k in range(1, nLevels):
+            # the larger of the two halves (the first if equal, as np.argmax)
+            half = 2**(k-1)
+            n = nSamples - 2**k + 1
+            left, right = table[..., k-1, :n], table[..., k-1, half:half+n]
+            takeRight = right > left
+            table[..., k, :n] = np.where(takeRight, right, left)
+            positions[..., k, :n] = np.where(takeRight, positions[..., k-1, half:half+n],
+                                             positions[..., k-1, :n])
+        index[name] = table
+        index[name + 'Arg'] = positions
+    return index
+
+
+# returns a peak index with the selected labels of each axis (None selects
+# all). All the selected labels must be in the index
+def selectPeakIndex(index, trials=None, jointModels=None, changes=None, variables=None):
+    selected = dict(index)
+    for axis, (name, labels) in enumerate(zip(STORE_AXES,
+                                              [trials, jointModels, changes, variables])):
+        if labels is None:
+            continue
+        positions = [index[name].index(label) for label in labels]
+        for table in PEAK_TABLES:
+            selected[table] = np.take(selected[table], positions, axis=axis)
+        selected[name] = list(labels)
+    return selected
+
+
+# peaks of every curve of a peak index in each window ([start, end) samples
+# of the gait cycle). stat is max or absMax
+# returns the peaks and their positions, arrays with axes trial, joint-model,
+# change, variable, window
+def queryPeaks(index, windows=[[40, 60]], stat='absMax'):
+    table, positions = index[stat], index[stat + 'Arg']
+    peaks, peakPositions = [], []
+    for start, end in windows:
+        # two (overlapping) blocks of 2**k samples cover the window
+        k = (end - start).bit_length() - 1
+        first, second = start, end - 2**k
+        takeSecond = table[..., k, second] > table[..., k, first]
+        peaks.append(np.where(takeSecond, table[..., k, second], table[..., k, first]))
+        peakPositions.append(np.where(takeSecond, positions[..., k, second],
+                                      positions[..., k, first]))
+    return np.stack(peaks, axis=-1), np.stack(peakPositions, axis=-1)
+
+
+# saves a peak index to fold: each table to kind_<table>.npy and the labels to
+# kind_peaks.json
+def savePeakIndex(index, kind, fold=STORE_FOLD):
+    if not os.path.isdir(fold):
+        os.makedirs(fold)
+    for table in PEAK_TABLES:
+        np.save(os.path.join(fold, '{}_{}.npy'.format(kind, table)), index[table])
+    with open(os.path.join(fold, kind + '_peaks.json'), 'w') as fp:
+        json.dump({name: index[name] for name in STORE_AXES}, fp, indent=1)
+
+
+# loads a peak index saved by savePeakIndex (memory-mapped, so a query only
+# reads the two entries of each curve and window)
+def loadPeakIndex(kind='JRF', fold=STORE_FOLD, mmap=True):
+    with open(os.path.join(fold, kind + '_peaks.json'), 'r') as fp:
+        index = json.load(fp)
+    for table in PEAK_TABLES:
+        index[table] = np.load(os.path.join(fold, '{}_{}.npy'.format(kind, table)),
+                               mmap_mode='r' if mmap else None)
+    return index
+
+
+class LazyResults(object):
+    '''
+    handle of the saved stores (see saveResultsStore) that reads the results
+    of a (result kind, trial, variables) only when they are first requested.
+    The last maxItems requested slices are kept in memory (least recently
+    used are released first)
+
+    Parameters
+    ----------
+    loadFile : string
+        the name given to the results files (prefix of STORE_FOLD)
+    maxItems : int
+        number of slices kept in memory
+    scaling  : float
+        the parameter to scale the derived variables (see deriveStore)
+    '''
+    def __init__(self, loadFile='', maxItems=32, scaling=1):
+        self.fold = loadFile + STORE_FOLD
+        self.maxItems = maxItems
+        self.scaling = scaling
+        # memory-mapped stores (only labels are read when opened)
+        self.stores = {}
+        # materialized slices, in the order of their last use
+        self.cache = collections.OrderedDict()
+
+    # labels of the axes of a result kind
+    def labels(self, kind):
+        store = self.open(kind)
+        return {name: store[name] for name in STORE_AXES}
+
+    # memory-mapped store of a result kind (JRF, SO or ACT)
+    def open(self, kind):
+        if kind not in self.stores:
+            self.stores[kind] = loadStore(kind, self.fold, mmap=True)
+        return self.stores[kind]
+
+    # store of a trial with the given variables (None for all, raw or derived)
+    # read into memory
+    def store(self, kind, trial, variables=None):
+        key = (kind, trial, None if variables is None else tuple(variables))
+        if key in self.cache:
+            # most recently used
+            store = self.cache.pop(key)
+        elif variables is not None and \
+                (set(variables) - set(self.open(kind)['variables'])) & set(DERIVED_VARIABLES):
+            store = deriveStore(selectStore(self.open(kind), [trial]), variables, self.scaling)
+        else:
+            store = selectStore(self.open(kind), [trial], variables=variables)
+            store['data'] = np.array(store['data'])
+        self.cache[key] = store
+        while len(self.cache) > self.maxItems:
+            self.cache.popitem(last=False)
+        return store
+
+    # results of a trial as dict of result file name -> variable -> samples
+    # (e.g. JRF[trial] in the dicts returned by saveModelResults)
+    def get(self, kind, trial, variables=None):
+        return storeToDict(self.store(kind, trial, variables))[trial]
+
+    # releases the materialized slices
+    def clear(self):
+        self.cache.clear()
+
+
+class ResultsCollector(object):
+    '''
+    collects the results of each simulation into the stores as soon as its
+    so and jr results are written (e.g. while runAnalysis is running). Each
+    simulation is validated and normalized, written to the memory-mapped
+    stores (JRF, SO and ACT) and released, so memory does not grow with the
+    number of simulations. The store of a kind is created with the variables
+    of its first valid simulation
+
+    Parameters
+    ----------
+    trials, jointModels, changes : list
+        labels of the axes of the stores (simulations with other labels are
+        skipped)
+    scaling     : float
+        the parameter to scale the results (e.g. BW)
+    saveFile    : string
+        the name given to the results files (prefix of STORE_FOLD)
+    resultsFold : string
+        folder containing the results of each trial
+
+    An instance can be passed as onJobDone to analysis.runAnalysis. close()
+    must be called when all simulations are collected
+    '''
+    def __init__(self, trials, jointModels, changes, scaling=1, saveFile='',
+                 resultsFold='Results'):
+        self.fold = saveFile + STORE_FOLD
+        self.scaling = scaling
+        self.resultsFold = resultsFold
+        self.labels = {'trials': list(trials), 'jointModels': list(jointModels),
+                       'changes': list(changes)}
+        # memory-mapped stores (created by the first valid simulation)
+        self.stores = {}
+        # validity records of each trial
+        self.reports = {trial: [] for trial in trials}
+
+    # called by runAnalysis with each finished so->jr job
+    def __call__(self, done):
+        # jr results are the last output
+        self.add(done['trial'], os.path.basename(done['outputs'][-1]))
+
+    # reads, validates, normalizes and stores the results of a simulation
+    def add(self, trial, jrFileName):
+        model, _, reduction = analysisDetails(jrFileName)
+        change = parseChange(reduction)
+        if trial not in self.labels['trials'] or model not in self.labels['jointModels'] \
+           or change not in self.labels['changes']:
+            print('{} is not collected (not in the axes of the stores)'.format(jrFileName))
+            return
+        index = (self.labels['trials'].index(trial),
+                 self.labels['jointModels'].index(model),
+                 self.labels['changes'].index(change))
+        with stage('collect', trial, model + reduction):
+            results = readResultFile(os.path.join(self.resultsFold, trial), jrFileName,
+                                     self.scaling, self.reports[trial])
+            if not results:
+                return
+            for kind, fileResults in zip(RESULT_KINDS, results):
+                store = self.stores.get(kind) or self.create(kind, fileResults)
+                data = store['data']
+                for v, variable in enumerate(store['variables']):
+                    if variable in fileResults:
+                        data[index + (v,)] = fileResults[variable]
+
+    # creates the memory-mapped store of a kind (all NaN)
+    def create(self, kind, fileResults):
+        if not os.path.isdir(self.fold):
+            os.makedirs(self.fold)
+        variables = sorted(fileResults)
+        nSamples = len(fileResults[variables[0]])
+        shape = tuple(len(self.labels[name]) for name in STORE_AXES[:3]) + \
+                (len(variables), nSamples)
+        data = np.lib.format.open_memmap(os.path.join(self.fold, kind + '.npy'),
+                                         mode='w+', dtype=float, shape=shape)
+        data[:] = np.nan
+        store = dict(self.labels, variables=variables, data=data)
+        with open(os.path.join(self.fold, kind + '.json'), 'w') as fp:
+            json.dump({name: store[name] for name in STORE_AXES}, fp, indent=1)
+        self.stores[kind] = store
+        return store
+
+    # writes the stores (and the peak indices of PEAK_INDEX_VARIABLES) to
+    # disk and the validity reports of the trials
+    def close(self):
+        for kind, store in self.stores.items():
+            store['data'].flush()
+            if kind in PEAK_INDEX_VARIABLES:
+                savePeakIndex(buildPeakIndex(deriveStore(store, PEAK_INDEX_VARIABLES[kind],
+                                                         self.scaling)), kind, self.fold)
+        for trial, report in self.reports.items():
+            if report:
+                writeValidityReport(os.path.join(self.resultsFold, trial), report)
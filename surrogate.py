@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import json
+import numpy as np
+from resultsStore import selectStore
+
+# candidate degrees of the polynomials (the one with the smallest
+# leave-one-out error is selected for each trial, joint-model and variable)
+DEGREES = [1, 2, 3]
+
+
+def fitSurrogate(store, variables=None, degrees=DEGREES):
+    '''
+    fits, for each trial and joint-model of a store, polynomials of the
+    percent change that predict the gait cycle curve of each variable (a
+    response surface of the strength change)
+
+    Parameters
+    ----------
+    store     : dict
+        results with labelled axes (see resultsStore.buildStore), e.g. JRF
+        or ACT. Invalid (NaN) simulations are not used
+    variables : list
+        variables to fit (None fits all the variables of the store)
+    degrees   : list
+        candidate polynomial degrees. A degree needs at least degree+2 valid
+        changes (for its leave-one-out error)
+
+    Return
+    ----------
+    surrogate : dict
+        trials, jointModels, variables (labels), coefs (array of trial,
+        joint-model, power, variable, sample, 0 above the degree of the
+        variable), degree (array of trial, joint-model, variable, -1 if not
+        fitted), range (array of trial, joint-model,
+        [min, max] fitted change, NaN if not fitted) and cvError (leave-one-out
+        rms error of each trial, joint-model, variable in the units of the
+        store)
+    '''
+    if variables is not None:
+        store = selectStore(store, variables=variables)
+    data = np.asarray(store['data'], dtype=float)
+    nTrials, nModels, _, nVariables, nSamples = data.shape
+    changes = np.array(store['changes'], dtype=float)
+    maxDegree = max(degrees)
+    coefs = np.zeros((nTrials, nModels, maxDegree + 1, nVariables, nSamples))
+    degree = -np.ones((nTrials, nModels, nVariables), dtype=int)
+    fitRange = np.full((nTrials, nModels, 2), np.nan)
+    cvError = np.full((nTrials, nModels, nVariables), np.nan)
+    for i in range(nTrials):
+        for j in range(nModels):
+            # changes with a valid simulation as rows, curves as columns
+            Y = data[i, j].reshape(len(changes), -1)
+            # samples out of the analyzed part of the gait cycle (NaN in all
+            # changes, see analysis.runAnalysis gcWindow) are not fitted
+            analyzed = np.isfinite(Y).any(axis=0)
+            valid = np.isfinite(Y[:, analyzed]).all(axis=1) & analyzed.any()
+            x, Y = changes[valid], np.where(analyzed, Y[valid], 0)
+            if not len(x):
+                continue
+            # coefficients and errors of each variable for each degree
+            fits = []
+            for d in degrees:
+                if len(x) < d + 2:
+                    continue
+                coef, loo = fitPolynomial(x, Y, d)
+                loo[:, ~analyzed] = np.nan
+                # rms of the leave-one-out residuals of each variable
+                squares = loo.reshape(len(x), nVariables, nSamples)**2
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    error = np.sqrt(np.nansum(squares, axis=(0, 2)) /
+                                    np.isfinite(squares).sum(axis=(0, 2)))
+                fits.append((d, coef, error))
+            if not fits:
+                # too few changes for an error estimate (interpolates them)
+                d = len(x) - 1
+                fits = [(d, fitPolynomial(x, Y, d)[0], np.full(nVariables, np.nan))]
+            # the degree of each variable (with the smallest error, the first
+            # degree if no error is known)
+            errors = np.array([error for _, _, error in fits])
+            best = np.argmin(np.where(np.isnan(errors), np.inf, errors), axis=0)
+            for v in range(nVariables):
+                d, coef, error = fits[best[v]]
+                coef = np.where(analyzed, coef, np.nan).reshape(d + 1, nVariables, nSamples)
+                coefs[i, j, :d+1, v] = coef[:, v]
+                degree[i, j, v] = d
+                cvError[i, j, v] = error[v]
+            fitRange[i, j] = [x.min(), x.max()]
+    return {'trials': list(store['trials']), 'jointModels': list(store['jointModels']),
+            'variables': list(store['variables']), 'coefs': coefs, 'degree': degree,
+            'range': fitRange, 'cvError': cvError}
+
+
+# least squares polynomial of degree d of x (percent change) fitting the rows
+# of Y. Returns the coefficients (powers of x/100 as rows) and the
+# leave-one-out residuals (from the diagonal of the hat matrix)
+def fitPolynomial(x, Y, d):
+    X = np.vander(x/100.0, d + 1, increasing=True)
+    pinv = np.linalg.pinv(X)
+    coef = pinv.dot(Y)
+    residual = Y - X.dot(coef)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        loo = residual/(1 - np.sum(X*pinv.T, axis=1))[:, None]
+    return coef, loo
+
+
+def predict(surrogate, trial, jointModel, change):
+    '''
+    predicts the curves of a trial and joint-model at a percent change
+
+    Parameters
+    ----------
+    surrogate  : dict
+        returned by fitSurrogate
+    trial      : string
+        trial name
+    jointModel : string
+        joint-model name (e.g. Knee)
+    change     : float
+        percent change of the strength
+
+    Return
+    ----------
+    curves       : dict
+        variable -> predicted gait cycle curve
+    cvError      : dict
+        variable -> leave-one-out rms error of the fit
+    extrapolated : bool
+        True if change is outside the fitted changes (not trusted)
+    '''
+    i = surrogate['trials'].index(trial)
+    j = surrogate['jointModels'].index(jointModel)
+    if (surrogate['degree'][i, j] < 0).all():
+        raise ValueError('no valid simulation of {} {}'.format(jointModel, trial))
+    # the coefficients above the degree of a variable are 0
+    coefs = surrogate['coefs'][i, j]
+    values = np.tensordot((change/100.0)**np.arange(len(coefs)), coefs, 1)
+    low, high = surrogate['range'][i, j]
+    return ({variable: values[v] for v, variable in enumerate(surrogate['variables'])},
+            {variable: surrogate['cvError'][i, j, v]
+             for v, variable in enumerate(surrogate['variables'])},
+            bool(change < low or change > high))
+
+
+# predicts a store (see resultsStore.buildStore) of the given changes, e.g. to
+# be passed to compare or plotTrial. NaN where a joint-model is not fitted.
+# The store also has extrapolated (array of trial, joint-model, change) and
+# cvError (array of trial, joint-model, variable)
+def predictStore(surrogate, changes, trials=None, jointModels=None):
+    trials = surrogate['trials'] if trials is None else list(trials)
+    jointModels = surrogate['jointModels'] if jointModels is None else list(jointModels)
+    ti = [surrogate['trials'].index(trial) for trial in trials]
+    mi = [surrogate['jointModels'].index(model) for model in jointModels]
+    coefs = surrogate['coefs'][ti][:, mi]
+    powers = (np.array(changes, dtype=float)[:, None]/100.0)**np.arange(coefs.shape[2])
+    # (trial, joint-model, change, variable, sample)
+    data = np.einsum('cp,tmpvs->tmcvs', powers, coefs)
+    degree = surrogate['degree'][ti][:, mi]
+    data[np.broadcast_to((degree < 0)[:, :, None], data.shape[:4])] = np.nan
+    fitRange = surrogate['range'][ti][:, mi]
+    x = np.array(changes, dtype=float)
+    with np.errstate(invalid='ignore'):
+        extrapolated = ~((x >= fitRange[..., :1]) & (x <= fitRange[..., 1:]))
+    return {'data': data, 'trials': trials, 'jointModels': jointModels,
+            'changes': list(changes), 'variables': list(surrogate['variables']),
+            'extrapolated': extrapolated, 'cvError': surrogate['cvError'][ti][:, mi]}
+
+
+# saves a surrogate to a .npz file (arrays and the labels)
+def saveSurrogate(surrogate, fileName='surrogate.npz'):
+    labels = {name: surrogate[name] for name in ['trials', 'jointModels', 'variables']}
+    np.savez(fileName, labels=json.dumps(labels), coefs=surrogate['coefs'],
+             degree=surrogate['degree'], range=surrogate['range'],
+             cvError=surrogate['cvError'])
+
+
+# loads a surrogate saved by saveSurrogate
+def loadSurrogate(fileName='surrogate.npz'):
+    with np.load(fileName) as saved:
+        surrogate = json.loads(str(saved['labels']))
+        for name in ['coefs', 'degree', 'range', 'cvError']:
+            surrogate[name] = saved[name]
+    return surrogate
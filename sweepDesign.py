@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import json
+import itertools
+import numpy as np
+from createModels import parseModel, writeModel, loadMuscleJoints, muscleScales
+
+# the muscle groups of the joints changed independently in factorial and
+# latin hypercube designs
+JOINT_FACTORS = {'Hip': ['hip_l'],
+                 'Knee': ['walker_knee_l'],
+                 'Ankle': ['ankle_l']}
+# parsed base models and their muscle->joints maps (per process, keyed by the
+# model file)
+BASE_MODELS = {}
+
+# A design is a dict of
+#   factors : factor name -> joints whose muscles are scaled by the factor
+#   points  : list of dicts, each with the name of a model and the percent
+#             change of each factor (factor name -> change)
+# Model names cannot contain '_' (see utils.analysisDetails). Names of the
+# multi-factor designs do not contain '+' or '-' either, so each point is a
+# joint-model with no change in the stores and the design file maps the
+# names to the changes
+
+
+def oneFactorDesign(groupNames={'Hip': ['hip_l'],
+                                'Knee': ['walker_knee_l'],
+                                'Ankle': ['ankle_l'],
+                                'Full': ['hip_l', 'walker_knee_l', 'ankle_l']},
+                    changeAmounts=[-40, -30, -20, -10, 0, 10, 20, 30, 40]):
+    '''
+    design changing one muscle group at a time (the design of createModels)
+
+    Parameters
+    ----------
+    groupNames    : dict
+        keys are the name of the modified models. Values are the muscle groups
+    changeAmounts : list
+        amount of percent changes to be applied on the joint strengths
+
+    Return
+    ----------
+    design        : dict
+        factors (groupNames) and a point for each change and group, named as
+        in createModels (e.g. Knee-40, Hip+10, Full)
+    '''
+    points = []
+    for change in changeAmounts:
+        for modelName in sorted(groupNames):
+            if change == 0:
+                name = modelName
+            else:
+                name = modelName + ["", "+"][change > 0] + '{:g}'.format(change)
+            points.append({'name': name, 'changes': {modelName: change}})
+    return {'factors': dict(groupNames), 'points': points}
+
+
+# one factor design on a fine grid of changes (start to stop, both included,
+# in steps of step percent). Integer steps keep the names compatible with the
+# changes axis of the stores
+def denseDesign(groupNames={'Hip': ['hip_l'],
+                            'Knee': ['walker_knee_l'],
+                            'Ankle': ['ankle_l']},
+                start=-60, stop=60, step=1):
+    nSteps = int(round((stop - start)/float(step)))
+    changes = [start + i*step for i in range(nSteps + 1)]
+    return oneFactorDesign(groupNames, changes)
+
+
+def factorialDesign(factors=JOINT_FACTORS, levels=[-40, -20, 0, 20, 40], prefix='FF'):
+    '''
+    full factorial design: every combination of the levels of the factors
+
+    Parameters
+    ----------
+    factors : dict
+        factor names and the joints whose muscles are scaled by the factor
+    levels  : list or dict
+        percent changes of all factors, or of each factor (factor -> list)
+    prefix  : string
+        the points are named prefix0000, prefix0001, ...
+
+    Return
+    ----------
+    design  : dict
+        factors and the points (see JOINT_FACTORS)
+    '''
+    names = sorted(factors)
+    if not isinstance(levels, dict):
+        levels = {name: levels for name in names}
+    points = [{'name': '{}{:04d}'.format(prefix, i), 'changes': dict(zip(names, changes))}
+              for i, changes in enumerate(itertools.product(*[levels[name] for name in names]))]
+    return {'factors': dict(factors), 'points': points}
+
+
+def latinHypercubeDesign(factors=JOINT_FACTORS, nSamples=50, bounds=[-60, 60],
+                         decimals=1, seed=None, prefix='LHS'):
+    '''
+    latin hypercube design: the range of each factor is divided into nSamples
+    intervals and each interval is sampled once (in random order)
+
+    Parameters
+    ----------
+    factors  : dict
+        factor names and the joints whose muscles are scaled by the factor
+    nSamples : int
+        number of points
+    bounds   : list or dict
+        [min, max] percent change of all factors, or of each factor
+    decimals : int
+        number of decimals of the changes
+    seed     : int
+        seed of the random generator
+    prefix   : string
+        the points are named prefix0000, prefix0001, ...
+
+    Return
+    ----------
+    design   : dict
+        factors and the points (see JOINT_FACTORS)
+    '''
+    rng = np.random.RandomState(seed)
+    names = sorted(factors)
+    if not isinstance(bounds, dict):
+        bounds = {name: bounds for name in names}
+    changes = {}
+    for name in names:
+        low, high = bounds[name]
+        # a random position in each interval, intervals in random order
+        u = (rng.permutation(nSamples) + rng.rand(nSamples))/nSamples
+        changes[name] = np.round(low + u*(high - low), decimals)
+    points = [{'name': '{}{:04d}'.format(prefix, i),
+               'changes': {name: float(changes[name][i]) for name in names}}
+              for i in range(nSamples)]
+    return {'factors': dict(factors), 'points': points}
+
+
+# saves a design to a json file (maps the model names to the changes)
+def saveDesign(design, fileName='design.json'):
+    with open(fileName, 'w') as fp:
+        json.dump(design, fp, indent=1, sort_keys=True)
+
+
+# loads a design saved by saveDesign
+def loadDesign(fileName='design.json'):
+    with open(fileName, 'r') as fp:
+        return json.load(fp)
+
+
+# writes the model of a design point (with its factors) to modelFile. The base
+# model is parsed once per process
+def materializeModel(point, factors, baseModelFile, modelFile):
+    if baseModelFile not in BASE_MODELS:
+        baseModel = parseModel(baseModelFile)
+        BASE_MODELS[baseModelFile] = (baseModel, loadMuscleJoints(baseModelFile, baseModel))
+    baseModel, muscleJoints = BASE_MODELS[baseModelFile]
+    writeModel(baseModel, point['name'], muscleScales(muscleJoints, factors, point['changes']),
+               modelFile)
+    return modelFile
@@ -4,13 +4,16 @@ Created on Wed Jan 20 09:52:02 2021
 
 @author: metin
 """
-import opensim as osim
 import numpy as np
 import os
+import json
+import hashlib
+import multiprocessing
 from scipy import interpolate
 import pandas as pd
 from scipy import signal
 from scipy.io import loadmat
+from instrumentation import stage
 try:
     import cPickle as pickle
 except ImportError:  # Python 3.x
@@ -37,6 +40,34 @@ JR_LOADS = {
                      'ankle_l_on_talus_l_in_talus_l_my',
                      'ankle_l_on_talus_l_in_talus_l_mz'])
     }
+# variables derived from the jr loads (computed when requested, see
+# deriveVariable), name -> definition
+#   kind   : resultant (magnitude of the inputs) or linear (sum of the inputs
+#            multiplied by coefs)
+#   inputs : jr columns
+#   coefs  : coefficients of the inputs (linear)
+#   clip   : lower bound of the variable (None for no bound)
+#   scaled : True if divided by the scaling (e.g. BW)
+DERIVED_VARIABLES = {
+    'hip': {'kind': 'resultant', 'inputs': list(JR_LOADS['hip'][:3]), 'scaled': True},
+    'knee': {'kind': 'resultant', 'inputs': list(JR_LOADS['knee'][:3]), 'scaled': True},
+    'ankle': {'kind': 'resultant', 'inputs': list(JR_LOADS['ankle'][:3]), 'scaled': True},
+    # lateral and medial knee loads from fz, fy and mx of the knee
+    'lateral': {'kind': 'linear', 'inputs': list(JR_LOADS['knee'][[2, 1, 3]]),
+                'coefs': [-0.997, -0.506, -17.9], 'clip': 0, 'scaled': True},
+    'medial': {'kind': 'linear', 'inputs': list(JR_LOADS['knee'][[2, 1, 3]]),
+               'coefs': [0.997, -0.494, 17.9], 'clip': 0, 'scaled': True},
+    }
+# a simulation is invalid if a reserve actuator exceeds this percentage of the
+# peak id moment of its coordinate
+RESERVE_LIMIT = 10
+# reserve actuators not checked
+RESERVE_EXCLUDED = ['hip_rotation']
+# peak id moments of the trials (keyed by the id file and its modification time)
+ID_MAXIMA = {}
+# opened results archives (see resultsArchive.useArchive). readSto reads the
+# storage files packed in them from the archives
+ARCHIVES = []
 
 # loads in-vivo JRFs from the saved file (divide it by scaling)
 def loadExpJRF(scaling=1):
@@ -74,21 +105,32 @@ def loadExpJRF(scaling=1):
 
 
 # loads model results from the saved file
+# (resultsStore.LazyResults loads only the requested trials and variables)
 # params:
 #    saveFile : the name given to the files containing the JRF, SO and ACT
+#    BW       : the parameter to scale the derived variables of the JRF (the
+#               pickles hold the raw jr loads, see deriveVariables)
 # returns:
-#   dicts containing JRF, SO and ACT
-def loadModelResults(loadFile=''):
-    try:
-        with open(loadFile + 'JRF.pkl', 'rb') as fp:
-            JRF = pickle.load(fp)
-        with open(loadFile + 'SO.pkl', 'rb') as fp:
-            SO = pickle.load(fp)
-        with open(loadFile + 'ACT.pkl', 'rb') as fp:
-            ACT = pickle.load(fp)
-            return JRF, SO, ACT
-    except:
+#   dicts containing JRF, SO and ACT (None if none of them is saved)
+def loadModelResults(loadFile='', BW=75*9.81):
+    results = []
+    missing = []
+    for kind in ['JRF', 'SO', 'ACT']:
+        fileName = loadFile + kind + '.pkl'
+        if not os.path.isfile(fileName):
+            missing.append(fileName)
+            continue
+        with open(fileName, 'rb') as fp:
+            results.append(pickle.load(fp))
+    if len(missing) == 3:
         print('JRFs are not saved')
+        return None
+    if missing:
+        raise IOError('Model results are partially saved, missing: {}'.format(
+            ', '.join(missing)))
+    # the derived variables are not saved (they are kept if saved before)
+    deriveVariables(results[0], scaling=BW)
+    return results[0], results[1], results[2]
 
 
 # reads JRF, SO and ACT of all valid analysis and saves them
@@ -97,154 +139,311 @@ def loadModelResults(loadFile=''):
 #   trials   : list of string (results should be written using folders with the same name as trials)
 #   scaling  : the parameter to scale the calculated total reaction forces
 #   saveFile : the name given to the files containing the JRF, SO and ACT
+#   nProcesses : number of worker processes reading the result files of a trial
 def saveModelResults(trials=['GC5_ss1', 'GC5_ss3', 'GC5_ss8', 'GC5_ss9', 'GC5_ss11'], BW=75*9.81,
-                     saveFile=''):
+                     saveFile='', nProcesses=1):
     # all JRF, SO and ACT are stored in a dict whose keys are the folder names (trials)
     JRF = {}
     SO = {}
     ACT = {}
     for fold in trials:
         # joint reaction forces in a dict whose keys are the filenames (scaling=BW)
-        JRF[fold], SO[fold], ACT[fold] = readResultFiles('Results\\'+fold, scaling=BW)
-    # store the JRF for each trial
-    with open(saveFile + 'JRF.pkl', 'wb') as fp:
-        pickle.dump(JRF, fp, protocol=pickle.HIGHEST_PROTOCOL)
-    # store the SO for each trial
-    with open(saveFile + 'SO.pkl', 'wb') as fp:
-        pickle.dump(SO, fp, protocol=pickle.HIGHEST_PROTOCOL)
-    # store the ACT for each trial
-    with open(saveFile + 'ACT.pkl', 'wb') as fp:
-        pickle.dump(ACT, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        with stage('readResultFiles', fold):
+            JRF[fold], SO[fold], ACT[fold] = readResultFiles(os.path.join('Results', fold),
+                                                             scaling=BW, nProcesses=nProcesses)
+    # the JRF are saved without the derived variables (see loadModelResults)
+    with stage('saveModelResults'):
+        # store the JRF for each trial
+        with open(saveFile + 'JRF.pkl', 'wb') as fp:
+            pickle.dump(JRF, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        # store the SO for each trial
+        with open(saveFile + 'SO.pkl', 'wb') as fp:
+            pickle.dump(SO, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        # store the ACT for each trial
+        with open(saveFile + 'ACT.pkl', 'wb') as fp:
+            pickle.dump(ACT, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    deriveVariables(JRF, scaling=BW)
     return JRF, SO, ACT
 
 
 # calculate the reaction forces from the joint reaction analysis
 # JRF, SO, ACT are the dictionaries containing jr analysis, static optimisation
 # and activations
+# the validity of each simulation is written to fold/validity.json
 # params:
 #   fold: contains the JRResults and SOResults subfolders
 #   scaling: the parameter to scale the results or calculated variables
-def readResultFiles(fold, scaling=1):
+#   nProcesses: number of worker processes reading (parse, validate and
+#               normalize) the files. Results are merged in the order of the
+#               sorted filenames
+def readResultFiles(fold, scaling=1, nProcesses=1):
     # jr results folder
-    jrResultsFold = fold + '\\JRResults'
+    jrResultsFold = os.path.join(fold, 'JRResults')
     # read the jr result files in the folder
-    files = [os.path.join(jrResultsFold, file) for file in os.listdir(jrResultsFold)]
+    fileNames = listResultFiles(jrResultsFold)
+    jobs = [(fold, fileName, scaling) for fileName in fileNames]
+    if nProcesses > 1:
+        # the workers read the same archives
+        pool = multiprocessing.Pool(nProcesses, setArchives, (ARCHIVES,))
+        try:
+            outputs = pool.map(readResultFileJob, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        outputs = [readResultFileJob(job) for job in jobs]
     # a dict to save all reaction forces from the files
     JRF = dict()
     SO = dict()
     ACT = dict()
-    for file in files:
-        # filename without the path
-        fileName = os.path.split(file)[1]
-        # check whether the simulation is valid (reserve actuator moments 
-        # not exceeding 10% of the ID moments)
-        check, soDict, soAct = checkSimulation(fold, fileName)
-        if check:
-            # normalize activations to gait cycle
-            for key, data in soAct.items():
-                soAct[key] = Normalize2GC(data)
-            # normalize so to gait cycle
-            for key, data in soDict.items():
-                data /= scaling
-                soDict[key] = Normalize2GC(data)
-            # forces of a file
-            jrDict = stoToNumpy(file)
-            for key, data in jrDict.items():
-                # normalize to the gait cycle
-                jrDict[key] = Normalize2GC(data)
-            for joint, forces in JR_LOADS.items():
-                # forces in x, y and z
-                fx = jrDict[forces[0]]
-                fy = jrDict[forces[1]]
-                fz = jrDict[forces[2]]
-                # the total joint reaction force of the joint
-                jrDict[joint] = ((fx**2 + fy**2 + fz**2)**0.5)/scaling
-                # if the joint is knee, calculate the lateral and medial loads
-                if joint.lower() == 'knee':
-                    # if the joint is knee, calculate lateral and medial forces
-                    tx = jrDict[forces[3]]
-                    flateral = -0.997*fz + 0.506*(-fy) - 17.9*tx
-                    fmedial = 0.997*fz+ 0.494*(-fy) + 17.9*tx
-                    jrDict['lateral'] = np.where(flateral>0, flateral/scaling, 0)
-                    jrDict['medial'] = np.where(fmedial>0, fmedial/scaling, 0)
+    # validity of each simulation
+    report = []
+    for fileName, (results, record) in zip(fileNames, outputs):
+        report.append(record)
+        if results:
             # save the reaction forces to the dict with the key being the filename
-            JRF[fileName] = jrDict
-            SO[fileName] = soDict
-            ACT[fileName] = soAct
-        # if exceeding 10%
-        else:
-            print('{} not a valid simulation'.format(file))
-
+            JRF[fileName], SO[fileName], ACT[fileName] = results
+    writeValidityReport(fold, report)
     return JRF, SO, ACT
 
+
+# sorted file names of a results folder (from the archives if the folder is
+# packed and removed)
+def listResultFiles(fold):
+    fileNames = set(os.listdir(fold)) if os.path.isdir(fold) else None
+    for archive in ARCHIVES:
+        packed = archive.listdir(fold)
+        if packed is not None:
+            fileNames = (fileNames or set()) | set(packed)
+    if fileNames is None:
+        raise IOError('{} is not found'.format(fold))
+    return sorted(fileNames)
+
+
+# sets the archives of a worker process of readResultFiles
+def setArchives(archives):
+    ARCHIVES[:] = archives
+
+
+# reads a result file for readResultFiles (in a worker process)
+# job is (fold, fileName, scaling). Returns the results of readResultFile and
+# the validity record of the simulation
+def readResultFileJob(job):
+    report = []
+    results = readResultFile(job[0], job[1], job[2], report)
+    return results, report[0]
+
+
+# reads the results of a simulation (jr result file fileName in fold)
+# returns the dicts of the jr forces, so forces and activations normalized to
+# the gait cycle (None if the simulation is not valid). The variables derived
+# from the jr forces (DERIVED_VARIABLES) are not computed (see
+# deriveVariables)
+# params:
+#   fold     : contains the JRResults and SOResults subfolders
+#   fileName : joint reaction result filename (without the path)
+#   scaling  : the parameter to scale the so results
+#   report   : list, the validity record of the simulation is appended
+def readResultFile(fold, fileName, scaling=1, report=None):
+    # check whether the simulation is valid (reserve actuator moments 
+    # not exceeding 10% of the ID moments)
+    check, soDict, soAct = checkSimulation(fold, fileName, report)
+    if not check:
+        return None
+    # part of the gait cycle of the results (e.g. of runAnalysis with
+    # gcWindow). It is out of the analyzed part
+    gcRange = getGCRange(fold, soDict['time'])
+    # normalize activations to gait cycle
+    soAct = normalizeDict2GC(soAct, gcRange=gcRange)
+    # normalize so to gait cycle
+    soDict = normalizeDict2GC(soDict, scaling, gcRange)
+    # forces of a file normalized to the gait cycle
+    jrDict = stoToNumpy(os.path.join(fold, 'JRResults', fileName))
+    jrDict = normalizeDict2GC(jrDict, gcRange=getGCRange(fold, jrDict['time']))
+    return jrDict, soDict, soAct
+
+
+# computes a derived variable (a definition of DERIVED_VARIABLES) from its
+# inputs. getInput returns the samples of an input, e.g. jrDict.get for the jr
+# forces of a file, or the slices of a stacked array to compute all at once
+def deriveVariable(definition, getInput, scaling=1):
+    inputs = [getInput(name) for name in definition['inputs']]
+    if definition['kind'] == 'resultant':
+        value = np.sqrt(sum(x**2 for x in inputs))
+    elif definition['kind'] == 'linear':
+        value = sum(c*x for c, x in zip(definition['coefs'], inputs))
+    else:
+        raise ValueError('unknown derived variable kind: ' + definition['kind'])
+    if definition.get('scaled'):
+        value = value/scaling
+    if definition.get('clip') is not None:
+        value = np.maximum(value, definition['clip'])
+    return value
+
+
+# adds the derived variables (names, None for all DERIVED_VARIABLES) to the
+# jr forces of each file in results (trial -> file -> variable -> samples,
+# e.g. JRF of saveModelResults). Returns results
+def deriveVariables(results, names=None, scaling=1, definitions=DERIVED_VARIABLES):
+    names = sorted(definitions) if names is None else names
+    for trialResults in results.values():
+        for fileResults in trialResults.values():
+            for name in names:
+                if name in definitions and name not in fileResults:
+                    fileResults[name] = deriveVariable(definitions[name], fileResults.get,
+                                                       scaling)
+    return results
+
+
+# interpolation operators used by Normalize2GC (keyed by the number of frames
+# and the part of the gait cycle)
+GC_OPERATORS = {}
+# first and last time of the gait cycle of each trial (see getCycleTimes)
+CYCLE_TIMES = {}
+
+
 # normalizes the given data into 0-100 (gaitcycle)
-def Normalize2GC(data):
+# data can be a column (frames) or a block of columns (frames x columns)
+# gcRange is the part of the gait cycle (%) of the first and the last frames.
+# The points of the gait cycle out of gcRange are NaN
+def Normalize2GC(data, gcRange=(0, 100)):
     # normalize data to gait cycle 0-100% (101 points)
-    tck = interpolate.splrep(np.linspace(0, 100, len(data)),
-                             data,
-                             s=0)
-    gc = interpolate.splev(np.linspace(0, 100, num=101),
-                           tck,
-                           der=0)
+    return getGCOperator(len(data), gcRange).dot(data)
+
+
+# returns the 101 x nFrames matrix of the cubic spline (s=0, not-a-knot)
+# interpolation from nFrames equally spaced points (spanning gcRange) to
+# 0-100% of the gait cycle (the rows out of gcRange are NaN)
+# the operator is computed once for each nFrames and gcRange
+def getGCOperator(nFrames, gcRange=(0, 100)):
+    start, end = [round(x, 6) for x in gcRange]
+    key = (nFrames, start, end)
+    if key not in GC_OPERATORS:
+        # interpolating each unit vector gives the columns of the operator
+        spline = interpolate.CubicSpline(np.linspace(start, end, nFrames),
+                                         np.eye(nFrames), axis=0)
+        points = np.linspace(0, 100, num=101)
+        operator = np.full((101, nFrames), np.nan)
+        inRange = (points >= start) & (points <= end)
+        operator[inRange] = spline(points[inRange])
+        GC_OPERATORS[key] = operator
+    return GC_OPERATORS[key]
+
+
+# first and last time of the gait cycle of a trial (fold), from id.sto (the
+# id of runAnalysis runs over the whole cycle)
+def getCycleTimes(fold):
+    idFile = os.path.join(fold, 'id.sto')
+    key = (os.path.abspath(idFile),
+           os.path.getmtime(idFile) if os.path.isfile(idFile) else None)
+    if key not in CYCLE_TIMES:
+        time = readSto(idFile)[2][:, 0]
+        CYCLE_TIMES[key] = time[0], time[-1]
+    return CYCLE_TIMES[key]
+
+
+# part of the gait cycle (%) of the results of a trial (fold) with the given
+# time column. Results starting or ending within half a frame of the cycle
+# cover the whole cycle (0, 100)
+def getGCRange(fold, time):
+    first, last = getCycleTimes(fold)
+    start, end = [100*(t - first)/(last - first) for t in [time[0], time[-1]]]
+    halfFrame = (end - start)/max(len(time) - 1, 1)/2
+    return (0 if start < halfFrame else start, 100 if end > 100 - halfFrame else end)
 
-    return gc
+
+# normalizes all columns of a dict (e.g. returned by stoToNumpy) to the gait
+# cycle at once and divides them by scaling. gcRange is the part of the gait
+# cycle of the data (see Normalize2GC)
+def normalizeDict2GC(dataDict, scaling=1, gcRange=(0, 100)):
+    labels = list(dataDict.keys())
+    gc = Normalize2GC(np.column_stack([dataDict[label] for label in labels]), gcRange)
+    if scaling != 1:
+        gc /= scaling
+    return {label: gc[:, col] for col, label in enumerate(labels)}
 
 
 # check whether the SO simulation is valid (compare the reserve forces between
-# id and so)
-def checkSimulation(fold, jrFileName):
-    printing = False
-    # initialize lists
-    soNames = []
-    idNames = []
-    percents = []
+# id and so). Only the so forces are read to check the reserve actuators, the
+# activations are read if the simulation is valid
+# returns:
+#   check, dict of so forces and dict of activations (None if not valid)
+# params:
+#   fold       : contains id.sto and the SOResults subfolder
+#   jrFileName : joint reaction result filename of the simulation
+#   report     : list, the validity record of the simulation is appended
+def checkSimulation(fold, jrFileName, report=None):
     # get the name of the model and subject and the amount of reduction in max iso
     model, subj, reduction = analysisDetails(jrFileName)
     # so results are saved with this prefix
     analysis = model + reduction + '_' + subj
-    soFileName = analysis + '_StaticOptimization_force.sto'
-    # full path to the sofile
-    soFile = fold + '\\SOResults\\' + soFileName
-    # add activations
-    soActFile = fold + '\\SOResults\\' + analysis + '_StaticOptimization_activation.sto'
-    # dict containing the activations
-    soAct = stoToNumpy(soActFile)
-    # dict containing the so results
-    soNumpy = stoToNumpy(soFile)
-    # id results filename and dict containing the results
-    idFile = fold + '\id.sto'
-    idNumpy = stoToNumpy(idFile)
-
-    # check hip, knee and ankle reserve actuators
-    joints = list(JR_LOADS.keys())
-    for idMomentName, idMoment in idNumpy.items():
-        # if idMomentName is related to one of the joints
-        if any(x in idMomentName for x in joints):
-            # define the reserve actuator name in so results
-            soKey = idMomentName[0:idMomentName.find('_moment')] + '_reserve'
-            # if the defined soKey exists
-            if soKey in list(soNumpy.keys()):
-                # get its value
-                soForce = soNumpy[soKey]
-                # get the corresponding id force
-                maxID = max(np.abs(idMoment))
-                # percent difference
-                percent = 100*np.abs(soForce)/maxID
-                # if the percent difference exceeds 10%, except hip_rot, report it
-                if max(percent) > 10 and 'hip_rotation' not in soKey:
-                    printing = True
-                    soNames.append(soKey)
-                    idNames.append(idMomentName)
-                    percents.append(max(percent))
-    # if there is an invalid simulation
-    if printing:
-        print('{}, {} and {} % change in max iso:'.format(model, subj, reduction))
-        for soname, idname, percent in zip(soNames, idNames, percents):
-              print('Invalid simulation {}/{}={}'.format(soname, idname, percent))
-        print('\n')
+    soPrefix = os.path.join(fold, 'SOResults', analysis + '_StaticOptimization_')
+    # so results
+    _, soLabels, soData = readSto(soPrefix + 'force.sto')
+    # peak id moments of the hip, knee and ankle and their reserve actuators
+    idNames, soKeys, _ = loadIDMaxima(fold)
+    checked, percents = getReservePercents(fold, soLabels, soData)
+    valid = not (percents > RESERVE_LIMIT).any()
+    record = {'file': jrFileName, 'model': model, 'subject': subj,
+              'change': reduction, 'valid': valid,
+              'reserves': [{'reserve': soKeys[i], 'id': idNames[i],
+                            'percent': float(percent),
+                            'valid': bool(percent <= RESERVE_LIMIT)}
+                           for i, percent in zip(checked, percents)]}
+    if report is not None:
+        report.append(record)
+    if not valid:
         return False, None, None
-    else:
-        return True, soNumpy, soAct
+    # dict containing the so results
+    soNumpy = {label: soData[:, col] for col, label in enumerate(soLabels)}
+    # dict containing the activations
+    soAct = stoToNumpy(soPrefix + 'activation.sto')
+    return True, soNumpy, soAct
+
+
+# percents of the peak id moments (loadIDMaxima of the trial fold) of the
+# reserve actuators (except RESERVE_EXCLUDED) in the so forces (soLabels and
+# soData rows x columns). Returns the indices of the checked reserves in the
+# lists of loadIDMaxima and their percents (array)
+def getReservePercents(fold, soLabels, soData):
+    idNames, soKeys, maxID = loadIDMaxima(fold)
+    # reserve actuators in so results (except the excluded ones)
+    soIndex = {label: col for col, label in enumerate(soLabels)}
+    checked = [i for i, soKey in enumerate(soKeys)
+               if soKey in soIndex and not any(x in soKey for x in RESERVE_EXCLUDED)]
+    soReserves = soData[:, [soIndex[soKeys[i]] for i in checked]]
+    # percent of the peak id moments (for all reserves at once)
+    return checked, 100*np.abs(soReserves).max(axis=0)/maxID[checked]
+
+
+# returns the names of the hip, knee and ankle id moments, the names of their
+# reserve actuators in so results and their peak absolute values (array)
+# id.sto of each trial (fold) is read once
+def loadIDMaxima(fold):
+    idFile = os.path.join(fold, 'id.sto')
+    # packed id files do not change
+    key = (os.path.abspath(idFile),
+           os.path.getmtime(idFile) if os.path.isfile(idFile) else None)
+    if key not in ID_MAXIMA:
+        _, idLabels, idData = readSto(idFile)
+        joints = list(JR_LOADS.keys())
+        # id moments related to one of the joints
+        cols = [col for col, name in enumerate(idLabels) if any(x in name for x in joints)]
+        idNames = [idLabels[col] for col in cols]
+        # the reserve actuator name in so results
+        soKeys = [name[0:name.find('_moment')] + '_reserve' for name in idNames]
+        ID_MAXIMA[key] = idNames, soKeys, np.abs(idData[:, cols]).max(axis=0)
+    return ID_MAXIMA[key]
+
+
+# writes the validity records (see checkSimulation) of the simulations in
+# fold to fold/validity.json and prints a summary
+def writeValidityReport(fold, report):
+    with open(os.path.join(fold, 'validity.json'), 'w') as fp:
+        json.dump(report, fp, indent=1)
+    nValid = sum(record['valid'] for record in report)
+    print('{}: {} of {} simulations are valid (see validity.json)'.format(
+        fold, nValid, len(report)))
 
 
 # splits the joint reaction result filename to get the name of the model, 
@@ -271,25 +470,109 @@ def analysisDetails(jrFileName):
     return model, subj, reduction
 
 
-# converts osim.Storage file into dict of numpy arrays
+# percent change of a model from the reduction returned by analysisDetails
+# (e.g. '-40', '+2.5' or '' for the nominal model). Whole changes are int (as
+# in getJRFileName), fractional ones (e.g. of the adaptive sweep) float
+def parseChange(reduction):
+    if not reduction:
+        return 0
+    change = float(reduction)
+    return int(change) if change.is_integer() else change
+
+
+# sha1 of the content of a file
+def hashFile(fileName, blockSize=1 << 20):
+    fileHash = hashlib.sha1()
+    with open(fileName, 'rb') as fp:
+        for block in iter(lambda: fp.read(blockSize), b''):
+            fileHash.update(block)
+    return fileHash.hexdigest()
+
+
+# joint reaction result filename of a model (e.g. Knee-40_GC5_ss1_JR_ReactionLoads.sto)
+# also the key of the SO and ACT results of the model
+def getJRFileName(model, change, trial):
+    fileName = model
+    if change > 0:
+        fileName += '+' + str(change)
+    elif change < 0:
+       fileName += str(change)
+    fileName += '_' + trial + '_JR_ReactionLoads.sto'
+    return fileName
+
+
+# converts an OpenSim storage file (.sto/.mot) into dict of numpy arrays
+# keys are the column labels (including time)
 def stoToNumpy(file):
-    storage = osim.Storage(file)
-    # number of columns and rows in storage
-    numCol = storage.getColumnLabels().getSize()
-    numRow = storage.getSize()
-
-    # storage will be saved to dict
-    dictStorage = dict()
-
-    # loop through columns
-    for col in range(numCol):
-        colName = storage.getColumnLabels().get(col)
-        # arraydouble to collect the data column from storage
-        arr = osim.ArrayDouble()
-        # save the column to arr_c
-        storage.getDataColumn(colName, arr)
-        # loop through rows to save the column
-        dictStorage[colName] = np.array([arr.get(row) for row in range(numRow)])
-
-    # return the dictionary containing the numpy arrays
-    return dictStorage
+    _, labels, data = readSto(file)
+    # each column is a view of the 2-D data block
+    return {label: data[:, col] for col, label in enumerate(labels)}
+
+
+# writes a 2-D array (rows x columns) with its column labels to an OpenSim
+# storage file (.sto/.mot) that can be read by readSto and OpenSim
+def writeSto(file, labels, data, name='', inDegrees=False, precision=15):
+    data = np.asarray(data, dtype=float).reshape(-1, len(labels))
+    with open(file, 'w') as fp:
+        fp.write('{}\nversion=1\nnRows={}\nnColumns={}\ninDegrees={}\nendheader\n'.format(
+            name or os.path.splitext(os.path.basename(file))[0], data.shape[0],
+            data.shape[1], ['no', 'yes'][inDegrees]))
+        fp.write('\t'.join(labels) + '\n')
+        np.savetxt(fp, data, fmt='%.{}g'.format(precision), delimiter='\t')
+
+
+# reads an OpenSim storage file (.sto/.mot) without OpenSim
+# returns:
+#   header : dict containing the name of the storage and the header entries
+#            (nRows, nColumns and inDegrees are converted to int and bool)
+#   labels : list of the column labels
+#   data   : 2-D numpy array (rows x columns), column i is labels[i]
+# files packed in an opened archive (ARCHIVES) are read from the archive
+# (data is a memory-mapped view)
+def readSto(file):
+    for archive in ARCHIVES:
+        sto = archive.readSto(file)
+        if sto is not None:
+            return sto
+    with open(file, 'r') as fp:
+        header = readStoHeader(fp)
+        # column labels are written just after endheader
+        labels = fp.readline().split()
+        # numeric block is parsed in one call
+        data = np.fromstring(fp.read(), sep=' ')
+    numCol = len(labels)
+    if numCol == 0 or data.size % numCol:
+        raise ValueError('{}: {} values cannot be arranged into {} columns'.format(
+            file, data.size, numCol))
+    data = data.reshape(-1, numCol)
+    # older storage files may declare fewer rows than written
+    numRow = header.get('nRows', data.shape[0])
+    if numRow < data.shape[0]:
+        data = data[:numRow]
+    return header, labels, data
+
+
+# reads the header lines of an opened storage file until endheader
+# the first line without "=" is the name of the storage
+def readStoHeader(fp):
+    header = {'name': ''}
+    # readline (not iteration) so that the rest of the file can still be read
+    # with fp.read() in Python 2
+    for line in iter(fp.readline, ''):
+        line = line.strip()
+        if line.lower() == 'endheader':
+            break
+        if '=' in line:
+            key, value = [x.strip() for x in line.split('=', 1)]
+            # old storage files use datarows/datacolumns
+            key = {'datarows': 'nRows', 'datacolumns': 'nColumns'}.get(key, key)
+            if key in ['nRows', 'nColumns']:
+                value = int(value)
+            elif key == 'inDegrees':
+                value = value.lower() == 'yes'
+            header[key] = value
+        elif line and not header['name']:
+            header['name'] = line
+    else:
+        raise ValueError('{} has no endheader'.format(getattr(fp, 'name', fp)))
+    return header